@@ -0,0 +1,123 @@
+"""
+Планы горячих запросов до и после индексов на синтетических данных.
+
+Создает отдельную базу <POSTGRES_DB>_bench, заливает в нее пользователей, заявки и ролики,
+выполняет EXPLAIN ANALYZE для запросов бота без индексов и с индексами из моделей.
+
+    python -m benchmarks.explain_hot_lookups --users 20000 --links 2000000
+"""
+import argparse
+import datetime
+import time
+
+from sqlalchemy import create_engine, text, select
+from sqlalchemy_utils.functions import database_exists, create_database, drop_database
+
+from config_data.bot_conf import conf
+from database.db import Base, User, Link, Request
+
+bench_url = f"postgresql+psycopg2://{conf.db.db_user}:{conf.db.db_password}@{conf.db.db_host}:{conf.db.db_port}/{conf.db.database}_bench"
+
+
+def fill(conn, users: int, requests: int, links: int):
+    conn.execute(text("""
+        INSERT INTO users (tg_id, username, register_date, cash, is_active)
+        SELECT g::text, 'user' || g, now(), 0, (g % 3 > 0)::int
+        FROM generate_series(1, :users) g
+    """), {'users': users})
+    conn.execute(text("""
+        INSERT INTO requests (user_id, register_date, status, cpm, channel_name)
+        SELECT 1 + g % :users, now(),
+               CASE WHEN g % 20 = 0 THEN 0 WHEN g % 7 = 0 THEN -1 ELSE 1 END,
+               100, 'channel ' || g
+        FROM generate_series(1, :requests) g
+    """), {'users': users, 'requests': requests})
+    conn.execute(text("""
+        INSERT INTO links (owner_id, register_date, link, link_type, status, view_count, cost, request_id)
+        SELECT 1 + g % :users, now() - (g % 365) * interval '1 day',
+               'https://example.com/' || g, (ARRAY['youtube', 'instagram', 'tiktok'])[1 + g % 3], 'moderate',
+               CASE WHEN g % 10 = 0 THEN 0 ELSE 1000 + g % 50000 END,
+               CASE WHEN g % 10 = 0 THEN 0 ELSE 100 + g % 5000 END,
+               1 + g % :requests
+        FROM generate_series(1, :links) g
+    """), {'users': users, 'requests': requests, 'links': links})
+    conn.execute(text('ANALYZE'))
+
+
+def hot_queries(users: int):
+    month_ago = datetime.datetime.now() - datetime.timedelta(days=30)
+    return {
+        'check_user (users.tg_id)':
+            select(User).where(User.tg_id == str(users // 2)),
+        'LinkMenu.get_queryset (links.view_count = 0, период)':
+            select(Link).where(Link.view_count == 0, Link.register_date > month_ago),
+        'LinkMenu.get_queryset юзера':
+            select(Link).where(Link.view_count == 0, Link.register_date > month_ago, Link.owner_id == users // 2),
+        'WebUserMenu: ролики юзера':
+            select(Link).where(Link.owner_id == users // 2).order_by(Link.register_date),
+        'get_user_request_active (requests.user_id, status)':
+            select(Request).where(Request.user_id == users // 2, Request.status == 1),
+        'get_unconfirmed_reg (requests.status = 0)':
+            select(Request).where(Request.status == 0).limit(100),
+    }
+
+
+def explain(conn, queries: dict):
+    for name, stmt in queries.items():
+        sql = str(stmt.compile(conn, compile_kwargs={'literal_binds': True}))
+        plan = conn.execute(text(f'EXPLAIN (ANALYZE, BUFFERS) {sql}')).scalars().all()
+        print(f'--- {name}')
+        print('\n'.join(plan))
+        print()
+
+
+def drop_indexes(conn):
+    for table in Base.metadata.sorted_tables:
+        for index in table.indexes:
+            conn.execute(text(f'DROP INDEX IF EXISTS {index.name}'))
+    conn.execute(text('ANALYZE'))
+
+
+def create_indexes(conn):
+    for table in Base.metadata.sorted_tables:
+        for index in table.indexes:
+            index.create(conn, checkfirst=True)
+    conn.execute(text('ANALYZE'))
+
+
+def main():
+    parser = argparse.ArgumentParser(description='EXPLAIN горячих запросов до и после индексов')
+    parser.add_argument('--users', type=int, default=20000)
+    parser.add_argument('--requests', type=int, default=40000)
+    parser.add_argument('--links', type=int, default=2000000)
+    parser.add_argument('--keep', action='store_true', help='Не удалять базу после прогона')
+    args = parser.parse_args()
+
+    if database_exists(bench_url):
+        drop_database(bench_url)
+    create_database(bench_url)
+    engine = create_engine(bench_url)
+    try:
+        Base.metadata.create_all(engine)
+        with engine.begin() as conn:
+            drop_indexes(conn)
+            start = time.perf_counter()
+            fill(conn, args.users, args.requests, args.links)
+            print(f'Данные загружены за {time.perf_counter() - start:.1f} с\n')
+        queries = hot_queries(args.users)
+        with engine.begin() as conn:
+            print('========== Без индексов ==========\n')
+            explain(conn, queries)
+            start = time.perf_counter()
+            create_indexes(conn)
+            print(f'Индексы созданы за {time.perf_counter() - start:.1f} с\n')
+            print('========== С индексами ==========\n')
+            explain(conn, queries)
+    finally:
+        engine.dispose()
+        if not args.keep:
+            drop_database(bench_url)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,83 @@
+"""
+Экспорт статистики в excel: старый способ (openpyxl, книга переоткрывается на каждого юзера)
+против однопроходного export_links_xlsx (xlsxwriter, constant_memory).
+
+Данные заливаются в отдельную базу <POSTGRES_DB>_bench (как в explain_hot_lookups).
+
+    python -m benchmarks.export_bench --users 1000 --links 500000
+"""
+import argparse
+import tempfile
+import time
+from pathlib import Path
+
+import pandas as pd
+from sqlalchemy import create_engine, select, distinct
+from sqlalchemy.orm import Session
+from sqlalchemy_utils.functions import database_exists, create_database, drop_database
+
+from benchmarks.explain_hot_lookups import bench_url, fill
+from database.db import Base, User, Link
+from services.db_func import export_links_xlsx, EXPORT_COLUMNS
+from services.link_stats import fill_empty_link_stats
+
+
+def legacy_export(session: Session, path: Path):
+    """Прежний save_stat_to_df: append в книгу через openpyxl на каждого юзера"""
+    with pd.ExcelWriter(path, engine="openpyxl", mode="w") as writer:
+        pd.DataFrame().to_excel(writer, sheet_name='Info', startrow=0, startcol=0)
+    all_users = session.execute(select(distinct(Link.owner_id))).scalars().all()
+    for user_id in all_users:
+        q = select(Link).where(Link.owner_id == user_id).order_by(Link.link_type.asc(), Link.register_date.asc())
+        user_links = session.execute(q).scalars().all()
+        user = session.get(User, user_id)
+        rows = [[link.id, link.register_date.strftime('%d.%m.%Y'), link.link, link.link_type,
+                 link.view_count, link.cost, user.username] for link in user_links]
+        df_to_save = pd.DataFrame(data=rows, index=None, columns=EXPORT_COLUMNS)
+        with pd.ExcelWriter(path, engine="openpyxl", mode="a") as writer:
+            df_to_save.to_excel(writer, sheet_name=str(f'{user.username}'), index=False, startrow=0, startcol=0)
+        session.expunge_all()
+
+
+def measure(name: str, func, engine, path: Path) -> float:
+    start = time.perf_counter()
+    with Session(engine) as session:
+        func(session, path)
+    elapsed = time.perf_counter() - start
+    print(f'{name}: {elapsed:.1f} с, {path.stat().st_size / 1024 / 1024:.1f} МБ')
+    return elapsed
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Скорость экспорта статистики в excel')
+    parser.add_argument('--users', type=int, default=1000)
+    parser.add_argument('--requests', type=int, default=2000)
+    parser.add_argument('--links', type=int, default=500000)
+    parser.add_argument('--skip-legacy', action='store_true', help='Не запускать старый экспорт')
+    parser.add_argument('--keep', action='store_true', help='Не удалять базу после прогона')
+    args = parser.parse_args()
+
+    if database_exists(bench_url):
+        drop_database(bench_url)
+    create_database(bench_url)
+    engine = create_engine(bench_url)
+    try:
+        Base.metadata.create_all(engine)
+        with engine.begin() as conn:
+            fill(conn, args.users, args.requests, args.links)
+            # Сводка link_daily_stats для листа Info
+            fill_empty_link_stats(conn)
+        print(f'Юзеров: {args.users}, роликов: {args.links}\n')
+        with tempfile.TemporaryDirectory() as tmp:
+            new = measure('xlsxwriter, один проход', export_links_xlsx, engine, Path(tmp) / 'new.xlsx')
+            if not args.skip_legacy:
+                old = measure('openpyxl, append на юзера', legacy_export, engine, Path(tmp) / 'old.xlsx')
+                print(f'\nУскорение: {old / new:.1f}x')
+    finally:
+        engine.dispose()
+        if not args.keep:
+            drop_database(bench_url)
+
+
+if __name__ == '__main__':
+    main()
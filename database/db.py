@@ -1,21 +1,25 @@
 import asyncio
 import datetime
+from itertools import groupby
 from typing import Sequence
 
 from aiogram.types import InlineKeyboardMarkup, InlineKeyboardButton
 from aiogram.utils.keyboard import InlineKeyboardBuilder
 from pydantic import json
 from sqlalchemy import create_engine, ForeignKey, Date, String, DateTime, \
-    Float, UniqueConstraint, Integer, LargeBinary, BLOB, select, ARRAY, func
+    Float, UniqueConstraint, Integer, LargeBinary, BLOB, select, ARRAY, func, update, Index, text, Row, and_, true
 from sqlalchemy.dialects.postgresql import JSONB
+from sqlalchemy.ext.asyncio import create_async_engine, async_sessionmaker, AsyncSession
 from sqlalchemy.orm import DeclarativeBase, relationship
 from sqlalchemy.orm import Mapped
 from sqlalchemy.orm import mapped_column
 from sqlalchemy.orm import sessionmaker
-from sqlalchemy_utils.functions import database_exists, create_database
+from sqlalchemy.orm.attributes import set_committed_value
 
 from config_data.bot_conf import conf, get_my_loggers, tz
+from database.read_models import WebUserStat, Channel, LinkCard
 from lexicon.lexicon import LEXICON
+from services.cache import user_cache, user_stat_cache, invalidate
 
 logger, err_log = get_my_loggers()
 
@@ -23,6 +27,12 @@ db_url = f"postgresql+psycopg2://{conf.db.db_user}:{conf.db.db_password}@{conf.d
 engine = create_engine(db_url, echo=False)
 Session = sessionmaker(bind=engine)
 
+# Асинхронный движок для хэндлеров: запросы не блокируют event loop бота.
+# Синхронный Session остается для скриптов.
+async_db_url = f"postgresql+asyncpg://{conf.db.db_user}:{conf.db.db_password}@{conf.db.db_host}:{conf.db.db_port}/{conf.db.database}"
+async_engine = create_async_engine(async_db_url, echo=False, pool_pre_ping=True)
+async_session = async_sessionmaker(bind=async_engine, expire_on_commit=False)
+
 
 class Base(DeclarativeBase):
     def set(self, key, value):
@@ -32,14 +42,52 @@ class Base(DeclarativeBase):
             _session.add(self)
             _session.commit()
             logger.debug(f'Изменено значение {key} на {value}')
+            self._invalidate_cache()
             return self
 
+    def _invalidate_cache(self, session=None):
+        """Сбрасывает кэш записи после изменения. Переопределяется в моделях с кэшем"""
+        pass
+
+    def _update_stmt(self, expect: dict = None, **fields):
+        model = type(self)
+        stmt = update(model).where(model.id == self.id)
+        for key, value in (expect or {}).items():
+            stmt = stmt.where(getattr(model, key) == value)
+        return stmt.values(**fields).returning(*model.__table__.c).execution_options(synchronize_session=False)
+
+    def _apply_row(self, row, session=None):
+        if row is None:
+            return None
+        self._invalidate_cache(session)
+        for key, value in row.items():
+            set_committed_value(self, key, value)
+        return self
+
+    def update(self, expect: dict = None, **fields):
+        """
+        Изменяет несколько полей одним UPDATE ... RETURNING и одним commit.
+        expect - compare-and-set, например {'status': 0}: строка изменится, только если статус еще 0.
+        Возвращает self с новыми значениями или None, если условие expect не выполнено.
+        """
+        with Session() as _session:
+            row = _session.execute(self._update_stmt(expect, **fields)).mappings().one_or_none()
+            _session.commit()
+        logger.debug(f'Изменены значения {fields} (условие {expect}): {row is not None}')
+        return self._apply_row(row)
+
+    async def aupdate(self, session: AsyncSession, expect: dict = None, **fields):
+        """Асинхронный update в сессии апдейта (без commit)"""
+        row = (await session.execute(self._update_stmt(expect, **fields))).mappings().one_or_none()
+        logger.debug(f'Изменены значения {fields} (условие {expect}): {row is not None}')
+        return self._apply_row(row, session)
+
 
 class User(Base):
     __tablename__ = 'users'
     id: Mapped[int] = mapped_column(primary_key=True,
                                     autoincrement='auto')
-    tg_id: Mapped[str] = mapped_column(String(30))
+    tg_id: Mapped[str] = mapped_column(String(30), unique=True, index=True)
     username: Mapped[str] = mapped_column(String(100), nullable=True)
     register_date: Mapped[datetime.datetime] = mapped_column(DateTime(), nullable=True)
     fio: Mapped[str] = mapped_column(String(200), nullable=True)
@@ -47,12 +95,18 @@ class User(Base):
     # cpm: Mapped[float] = mapped_column(Float(precision=1), default=0)
     is_active: Mapped[int] = mapped_column(Integer(), default=0)
     trc20: Mapped[str] = mapped_column(String(50), nullable=True)
-    links: Mapped[list['Link']] = relationship(back_populates='owner', lazy='subquery')
-    requests: Mapped[list['Request']] = relationship(back_populates='owner', lazy='subquery')
+    links: Mapped[list['Link']] = relationship(back_populates='owner', lazy='raise_on_sql')
+    requests: Mapped[list['Request']] = relationship(back_populates='owner', lazy='raise_on_sql')
     # work_link: Mapped[int] = mapped_column(ForeignKey('work_links.id', ondelete='CASCADE'), nullable=True)
     # work_link_requests: Mapped[list['WorkLinkRequest']] = relationship(back_populates='owner', lazy='subquery')
-    cash_outs: Mapped[list['CashOut']] = relationship(back_populates='user', lazy='subquery')
+    cash_outs: Mapped[list['CashOut']] = relationship(back_populates='user', lazy='raise_on_sql')
     # source: Mapped[str] = mapped_column(String(50), nullable=True)
+    # Отметка изменения для отпечатка данных экспорта (services/export.py)
+    updated_at: Mapped[datetime] = mapped_column(DateTime(timezone=True), index=True,
+                                                 server_default=func.now(), onupdate=func.clock_timestamp())
+
+    def _invalidate_cache(self, session=None):
+        invalidate(user_cache, self.tg_id, session)
 
     def __str__(self):
         return f'{self.id}. @{self.username or "-"} ({self.fio or self.tg_id}). Баланс {self.cash}'
@@ -64,31 +118,33 @@ class User(Base):
 class WebUserMenu:
     PAGINATE = 20
 
-    def __init__(self, user_id=0):
+    def __init__(self, session: AsyncSession, user_id=0):
+        self.session = session
         self.user_id = user_id
 
-    @property
-    def user(self) -> User:
-        session = Session()
-        with session:
-            user = select(User).where(User.id == self.user_id)
-            user = session.execute(user).scalar()
-            return user
+    async def get_username(self) -> str:
+        return (await self.session.execute(select(User.username).where(User.id == self.user_id))).scalar()
+
+    async def count(self) -> int:
+        q = select(func.count()).select_from(User).where(User.is_active == 1)
+        return (await self.session.execute(q)).scalar()
+
+    async def get_page(self, page: int) -> Sequence[Row]:
+        """Страница активных вэбмастеров: только id и username, LIMIT/OFFSET на стороне БД"""
+        q = (
+            select(User.id, User.username)
+            .where(User.is_active == 1)
+            .order_by(User.id)
+            .limit(self.PAGINATE)
+            .offset(self.PAGINATE * page)
+        )
+        return (await self.session.execute(q)).all()
 
-    @staticmethod
-    def get_queryset():
-        session = Session()
-        with session:
-            users = select(User).where(User.is_active == 1)
-            users = session.execute(users).scalars().all()
-            return users
-
-    def text(self):
+    async def text(self):
         if not self.user_id:
             text = f'Выберите вэбмастера'
         else:
-            user = self.user
-            text = f'Статистика пользователя {user.id}. {user.username}\n (CPM: {user.cpm})'
+            text = f'Статистика пользователя {self.user_id}. {await self.get_username()}'
         return text
 
     @staticmethod
@@ -96,7 +152,7 @@ class WebUserMenu:
         kb_builder: InlineKeyboardBuilder = InlineKeyboardBuilder()
         buttons = []
         if menus:
-            item_btn1 = InlineKeyboardButton(text='<<', callback_data='>>')
+            item_btn1 = InlineKeyboardButton(text='<<', callback_data='<<')
             stat_bn = InlineKeyboardButton(text=menus, callback_data='*')
             item_btn2 = InlineKeyboardButton(text='>>', callback_data='>>')
             kb_builder.row(item_btn1, stat_bn, item_btn2)
@@ -108,11 +164,11 @@ class WebUserMenu:
         kb_builder.row(*buttons, width=width)
         return kb_builder.as_markup()
 
-    def nav_menu(self, user_id=0, page=0):
+    async def nav_menu(self, user_id=0, page=0):
         if not user_id:
-            queryset = self.get_queryset()
-            max_page = len(queryset) // self.PAGINATE
-            if len(queryset) % self.PAGINATE != 0:
+            total = await self.count()
+            max_page = total // self.PAGINATE
+            if total % self.PAGINATE != 0:
                 max_page += 1
             if max_page == 0:
                 page = 0
@@ -121,12 +177,12 @@ class WebUserMenu:
             start = self.PAGINATE * page
             end = start + self.PAGINATE
             logger.debug(f'page: {page}. {start} - {end}')
-            users = queryset[start:end]
+            users = await self.get_page(page)
             nav_btn = {}
-            for user in users:
-                nav_btn[f'{user.id} {user.username}'] = f'active_web_n:{user.id}'
-            if len(queryset) > self.PAGINATE:
-                menus = f'{start + 1} - {min(end, len(queryset))} из {len(queryset)}'
+            for pk, username in users:
+                nav_btn[f'{pk} {username}'] = f'active_web_n:{pk}'
+            if total > self.PAGINATE:
+                menus = f'{start + 1} - {min(end, total)} из {total}'
             else:
                 menus = ''
             nav_btn.update({'Назад': 'cancel'})
@@ -160,31 +216,67 @@ class WebUserMenu:
     #                 text += '\n'
     #     return text[:4000]
 
-    def user_stat(self):
+    async def get_stat(self) -> WebUserStat | None:
+        """
+        Итоги по роликам юзера и его активные каналы одним запросом:
+        строка на канал, итоги из подзапроса по сводке link_daily_stats повторяются в каждой строке.
+        Результат кэшируется в user_stat_cache.
+        """
+        stat = user_stat_cache.get(self.user_id)
+        if stat is not None:
+            return stat
+        totals = (
+            select(func.coalesce(func.sum(LinkDailyStats.links), 0).label('links'),
+                   func.coalesce(func.sum(LinkDailyStats.views), 0).label('views'),
+                   func.coalesce(func.sum(LinkDailyStats.cost), 0).label('cost'))
+            .where(LinkDailyStats.owner_id == self.user_id)
+            .subquery()
+        )
+        q = (
+            select(User.id, User.username, totals.c.links, totals.c.views, totals.c.cost,
+                   Request.id, Request.channel_name, Request.cpm)
+            .select_from(User)
+            .join(totals, true())
+            .outerjoin(Request, and_(Request.user_id == User.id, Request.status == 1))
+            .where(User.id == self.user_id)
+            .order_by(Request.id)
+        )
+        rows = (await self.session.execute(q)).all()
+        if not rows:
+            return None
+        channels = [Channel(*row[5:]) for row in rows if row[5] is not None]
+        stat = WebUserStat(*rows[0][:5], channels)
+        user_stat_cache.set(self.user_id, stat)
+        return stat
+
+    async def user_stat(self):
         if not self.user_id:
             return 'Выберите пользователя'
-        sum_view = 0
-        sum_cost = 0
-        for link in self.user.links:
-            sum_view += link.view_count
-            sum_cost += link.cost
+        stat = await self.get_stat()
+        if not stat:
+            return 'Пользователь не найден'
         channels_info = f'Каналы:\n'
-        for channel in self.user.requests:
-            if channel.status == 1:
-                channels_info += f'{channel.id}. {channel.channel_name}. cpm {channel.cpm}\n'
-        text = f'{self.user.username}\n{channels_info}\nКоличество роликов: {len(self.user.links)}\nКоличество просмотров: {sum_view}\nВыплаты: {sum_cost} руб.'
+        for channel in stat.channels:
+            channels_info += f'{channel.id}. {channel.channel_name}. cpm {channel.cpm}\n'
+        text = f'{stat.username}\n{channels_info}\nКоличество роликов: {stat.links}\nКоличество просмотров: {stat.views}\nВыплаты: {stat.cost} руб.'
         return text[:4000]
 
 
 class Request(Base):
     # Запрос на модерацию нового канала
     __tablename__ = 'requests'
+    __table_args__ = (
+        # get_user_request_active
+        Index('ix_requests_user_status', 'user_id', 'status'),
+        # get_unconfirmed_reg: заявки на модерации
+        Index('ix_requests_pending', 'id', postgresql_where=text('status = 0')),
+    )
     id: Mapped[int] = mapped_column(primary_key=True,
                                     autoincrement='auto')
     register_date: Mapped[datetime] = mapped_column(DateTime(timezone=True), nullable=True,
                                                 default=lambda: datetime.datetime.now(tz=tz))
     user_id: Mapped[int] = mapped_column(ForeignKey('users.id', ondelete='CASCADE'))
-    owner: Mapped['User'] = relationship(back_populates='requests', lazy='subquery')
+    owner: Mapped['User'] = relationship(back_populates='requests', lazy='raise_on_sql')
     text: Mapped[str] = mapped_column(String(4000), nullable=True)
     status: Mapped[int] = mapped_column(Integer(), default=0)
     reject_text: Mapped[str] = mapped_column(String(4000), nullable=True)
@@ -192,7 +284,17 @@ class Request(Base):
     source: Mapped[str] = mapped_column(String(50), nullable=True, comment='Источник (Ютюб и т.д.')
     channel_name: Mapped[str] = mapped_column(String(500), nullable=True, comment='Имя канала')
     cpm: Mapped[float] = mapped_column(Float(precision=1), default=0)
-    links: Mapped[list['Link']] = relationship(back_populates='request', lazy='subquery')
+    links: Mapped[list['Link']] = relationship(back_populates='request', lazy='raise_on_sql')
+    # Заявка взята модератором в работу до claimed_until (services/work_queue.py)
+    claimed_by: Mapped[int] = mapped_column(Integer(), nullable=True)
+    claimed_until: Mapped[datetime] = mapped_column(DateTime(timezone=True), nullable=True)
+    # Отметка изменения для отпечатка данных экспорта (services/export.py)
+    updated_at: Mapped[datetime] = mapped_column(DateTime(timezone=True), index=True,
+                                                 server_default=func.now(), onupdate=func.clock_timestamp())
+
+    def _invalidate_cache(self, session=None):
+        # Каналы и cpm в карточке вэбмастера
+        invalidate(user_stat_cache, self.user_id, session)
 
     def __str__(self):
         return f'Request {self.id}. {self.channel_name}'
@@ -203,10 +305,18 @@ class Request(Base):
 
 class Link(Base):
     __tablename__ = 'links'
+    __table_args__ = (
+        Index('ix_links_owner_register', 'owner_id', 'register_date'),
+        # LinkMenu и очередь модерации: неоцененные ролики за период
+        Index('ix_links_unpriced', 'register_date', postgresql_where=text('view_count = 0')),
+        # services/payouts.py: оцененные ролики, еще не вошедшие в выплату
+        Index('ix_links_unsettled', 'register_date',
+              postgresql_where=text('cost > 0 AND payout_run_id IS NULL')),
+    )
     id: Mapped[int] = mapped_column(primary_key=True,
                                     autoincrement='auto')
     owner_id: Mapped[int] = mapped_column(ForeignKey('users.id', ondelete='CASCADE'))
-    owner: Mapped['User'] = relationship(back_populates='links', lazy='subquery')
+    owner: Mapped['User'] = relationship(back_populates='links', lazy='raise_on_sql')
     register_date: Mapped[datetime] = mapped_column(DateTime(timezone=True), nullable=True,
                                                     default=lambda: datetime.datetime.now(tz=tz))
     link: Mapped[str] = mapped_column(String(1000), unique=True)
@@ -217,7 +327,19 @@ class Link(Base):
     cost: Mapped[int] = mapped_column(Integer(), default=0)
     msg: Mapped[json] = mapped_column(JSONB(), nullable=True)
     request_id: Mapped[int] = mapped_column(ForeignKey('requests.id', ondelete='CASCADE'))
-    request: Mapped['Request'] = relationship(back_populates='links', lazy='subquery')
+    request: Mapped['Request'] = relationship(back_populates='links', lazy='raise_on_sql')
+    # Отметка изменения для отпечатка данных экспорта (services/export.py)
+    updated_at: Mapped[datetime] = mapped_column(DateTime(timezone=True), index=True,
+                                                 server_default=func.now(), onupdate=func.clock_timestamp())
+    # Ролик взят модератором в работу до claimed_until (services/work_queue.py)
+    claimed_by: Mapped[int] = mapped_column(Integer(), nullable=True)
+    claimed_until: Mapped[datetime] = mapped_column(DateTime(timezone=True), nullable=True)
+    # Выплата, в которую вошел ролик (PayoutRun)
+    payout_run_id: Mapped[int] = mapped_column(Integer(), nullable=True)
+
+    def _invalidate_cache(self, session=None):
+        # Итоги по роликам в карточке вэбмастера (оценка просмотров и т.п.)
+        invalidate(user_stat_cache, self.owner_id, session)
 
     def __str__(self):
         return f'{self.id}. {self.link}'
@@ -229,19 +351,23 @@ class Link(Base):
 class LinkMenu:
     PAGINATE = 10
 
-    def __init__(self, n=None, user_id=0, link_period=3, **kwargs):
+    def __init__(self, session: AsyncSession, n=None, user_id=0, link_period=3, **kwargs):
+        self.session = session
         self.n = n
-        self.link_period = link_period
+        # Из очереди модерации периода в состоянии нет: за все время
+        self.link_period = link_period or 3
         self.user_id = user_id
+        # Загруженная страница (load_page): номер после нормализации, всего роликов, строки
+        self.page = 0
+        self.total = 0
+        self.links = None
+        self._loaded_page = None
+        # Карточка ролика (get_card)
+        self.card = None
         print(f'LinkMenu init: {self.n} period: {self.link_period} user {self.user_id}')
 
-    @property
-    def user(self):
-        session = Session()
-        with session:
-            user = select(User).where(User.id == self.user_id)
-            user = session.execute(user).scalar()
-            return user
+    async def get_username(self) -> str:
+        return (await self.session.execute(select(User.username).where(User.id == self.user_id))).scalar()
 
     @property
     def start_period(self):
@@ -260,26 +386,41 @@ class LinkMenu:
         elif self.link_period == 2:
             return datetime.datetime.now() - datetime.timedelta(days=30)
 
-    def get_queryset(self, start_date=datetime.datetime(2024, 1, 1)):
-        session = Session()
-        print(start_date)
-        with session:
-            links = select(Link).where(
-                Link.cost == 0,
-                Link.register_date > start_date
-            )
-            if self.link_period == 1:
-                links = links.where(Link.register_date < datetime.datetime.now() - datetime.timedelta(days=14))
-            if self.user_id:
-                links = links.where(Link.owner_id == self.user_id)
-            links = session.execute(links).scalars().all()
-            return links
+    def _filter(self, q):
+        q = q.where(Link.view_count == 0, Link.register_date > self.start_period)
+        if self.link_period == 1:
+            q = q.where(Link.register_date < datetime.datetime.now() - datetime.timedelta(days=14))
+        if self.user_id:
+            q = q.where(Link.owner_id == self.user_id)
+        return q
+
+    async def count(self) -> int:
+        q = self._filter(select(func.count()).select_from(Link))
+        return (await self.session.execute(q)).scalar()
 
-    def text(self):
+    async def load_page(self, page=0) -> Sequence[Row]:
+        """
+        Страница роликов без выплат: COUNT и LIMIT/OFFSET на стороне БД, только нужные колонки.
+        Результат запоминается - text и nav_menu одного меню используют один запрос.
+        """
+        if self.links is not None and self._loaded_page == page:
+            return self.links
+        self.total = await self.count()
+        max_page = -(-self.total // self.PAGINATE)
+        self.page = page % max_page if max_page else 0
+        q = self._filter(
+            select(Link.id, Link.link, Link.link_type, Link.register_date, Link.view_count, Link.cost, Request.cpm)
+            .outerjoin(Request, Request.id == Link.request_id)
+        )
+        q = q.order_by(Link.link_type, Link.register_date, Link.id).limit(self.PAGINATE).offset(self.PAGINATE * self.page)
+        self.links = (await self.session.execute(q)).all()
+        self._loaded_page = page
+        return self.links
+
+    async def text(self, page=0):
         text = 'Просмотр роликов '
-        print('text', f'user: {self.user_id}')
         if self.user_id:
-            text += f'пользователя {self.user.username}\n'
+            text += f'пользователя {await self.get_username()}\n'
         if self.link_period == 1:
             text += f'за 14+ дней\n'
         if self.link_period == 2:
@@ -288,17 +429,14 @@ class LinkMenu:
             text += f'за все время\n'
         if self.link_period == 4:
             text += f'за 7 дней\n'
-        print(f'start_period: {self.start_period}')
-        links = self.get_queryset(start_date=self.start_period)
-        print('links', links)
-        link_types = ['youtube', 'instagram', 'tiktok']
-        for link_type in link_types:
+        # Только ролики текущей страницы: текст не упирается в лимит ТГ
+        links = await self.load_page(page)
+        for link_type, type_links in groupby(links, key=lambda row: row.link_type):
             text += f'\n<b>{link_type}:</b>\n'
-            for link in links:
-                if link.link_type == link_type:
-                    data = [f'<a href="{link.link}">{link.id}. {link_type}</a>', str(link.register_date.strftime('%d.%m.%Y')), str(link.view_count), str(link.cost), f'cpm {link.request.cpm}']
-                    text += ' - '.join(data)
-                    text += '\n'
+            for link in type_links:
+                data = [f'<a href="{link.link}">{link.id}. {link_type}</a>', str(link.register_date.strftime('%d.%m.%Y')), str(link.view_count), str(link.cost), f'cpm {link.cpm}']
+                text += ' - '.join(data)
+                text += '\n'
         text += '\n\nВыберите ролик'
         return text
 
@@ -319,27 +457,21 @@ class LinkMenu:
         kb_builder.row(*buttons, width=width)
         return kb_builder.as_markup()
 
-    def nav_menu(self, link_id=0, page=0):
+    async def nav_menu(self, link_id=0, page=0):
         logger.debug(f'Меню LinkMenu. period: {self.link_period}, link_id: {link_id}, user: {self.user_id}')
         nav_btn = {}
-        if self.n and self.get_link_from_id(self.n).view_count == 0:
+        if self.n and (await self.get_card(self.n)).view_count == 0:
             nav_btn.update({'Изменить количество просмотров': f'link_view_change:{self.n}'})
         if not link_id:
-            queryset = self.get_queryset(start_date=self.start_period)
+            links = await self.load_page(page)
             menus = ''
-            if queryset:
-                max_page = len(queryset) // self.PAGINATE
-                if len(queryset) % self.PAGINATE != 0:
-                    max_page += 1
-                page = page % max_page
-                start = self.PAGINATE * page
-                end = start + self.PAGINATE
-                logger.debug(f'page: {page}. {start} - {end}')
-                links: Sequence[Link] = queryset[start:end]
-                for link in links:
-                    nav_btn[f'{link.id}. {link.link_type} {link.register_date.strftime("%d.%m%Y")} ({link.view_count})'] = f'links_id:{link.id}'
-                if len(queryset) > self.PAGINATE:
-                    menus = f'{start + 1} - {min(end, len(queryset))} из {len(queryset)}'
+            start = self.PAGINATE * self.page
+            end = start + self.PAGINATE
+            logger.debug(f'page: {page}. {start} - {end}')
+            for link in links:
+                nav_btn[f'{link.id}. {link.link_type} {link.register_date.strftime("%d.%m.%Y")} ({link.view_count})'] = f'links_id:{link.id}'
+            if self.total > self.PAGINATE:
+                menus = f'{start + 1} - {min(end, self.total)} из {self.total}'
             if self.user_id:
                 nav_btn.update({'Назад': f'show_user_links:{self.user_id}'})
             else:
@@ -350,22 +482,23 @@ class LinkMenu:
         }
         return self.custom_kb(1, nav_btn, menus='')
 
-    @staticmethod
-    def get_link_from_id(pk) -> Link:
-        try:
-            session = Session()
-            with session:
-                q = select(Link).filter(Link.id == pk)
-                link = session.execute(q).scalars().one_or_none()
-                return link
-        except Exception as err:
-            logger.error(err)
-
-    def link_stat(self, pk):
-        link: Link = self.get_link_from_id(pk)
+    async def get_card(self, pk) -> LinkCard | None:
+        """Карточка ролика одним запросом, запоминается для nav_menu того же экрана"""
+        if self.card is None or self.card.id != pk:
+            q = (
+                select(Link.id, Link.link, User.username, Link.register_date, Link.view_count, Link.cost)
+                .join(User, User.id == Link.owner_id)
+                .where(Link.id == pk)
+            )
+            row = (await self.session.execute(q)).one_or_none()
+            self.card = LinkCard(*row) if row else None
+        return self.card
+
+    async def link_stat(self, pk):
+        link = await self.get_card(pk)
         text = (
             f'Видео {link.id}. {link.link}\n'
-            f'Пользователь: {link.owner.username}\n'
+            f'Пользователь: {link.username}\n'
             f'Дата: {link.register_date.strftime("%d.%m.%Y")}\n'
             f'Просмотров: {link.view_count}\n'
             f'Стоимость: {link.cost}\n'
@@ -415,15 +548,69 @@ class CashOut(Base):
     id: Mapped[int] = mapped_column(primary_key=True,
                                     autoincrement='auto')
     user_id: Mapped[int] = mapped_column(ForeignKey('users.id', ondelete='CASCADE'))
-    user: Mapped['User'] = relationship(back_populates='cash_outs', lazy='subquery')
+    user: Mapped['User'] = relationship(back_populates='cash_outs', lazy='raise_on_sql')
     trc20: Mapped[str] = mapped_column(String(50), nullable=True)
     cost: Mapped[int] = mapped_column(Integer(), default=0)
     status: Mapped[int] = mapped_column(Integer(), default=0)
     moderator_id: Mapped[int] = mapped_column(Integer(), nullable=True)
     msg: Mapped[json] = mapped_column(JSONB(), nullable=True)
     reject_text: Mapped[str] = mapped_column(String(1000), nullable=True)
+    payout_run_id: Mapped[int] = mapped_column(Integer(), nullable=True, index=True)
+
+
+class PayoutRun(Base):
+    # Выплата вэбмастерам за период одной операцией (services/payouts.py)
+    __tablename__ = 'payout_runs'
+    id: Mapped[int] = mapped_column(primary_key=True,
+                                    autoincrement='auto')
+    created: Mapped[datetime] = mapped_column(DateTime(timezone=True),
+                                              default=lambda: datetime.datetime.now(tz=tz))
+    moderator_id: Mapped[int] = mapped_column(Integer(), nullable=True)
+    period_start: Mapped[datetime] = mapped_column(DateTime(timezone=True))
+    period_end: Mapped[datetime] = mapped_column(DateTime(timezone=True))
+    users: Mapped[int] = mapped_column(Integer(), default=0)
+    links: Mapped[int] = mapped_column(Integer(), default=0)
+    total: Mapped[int] = mapped_column(Integer(), default=0)
+
+    def __repr__(self):
+        return f'Payout {self.id}. {self.period_start:%d.%m.%Y} - {self.period_end:%d.%m.%Y}: {self.total}'
+
 
+class CashLedger(Base):
+    # Журнал движения баланса. Записи только добавляются, User.cash должен равняться сумме amount
+    __tablename__ = 'cash_ledger'
+    id: Mapped[int] = mapped_column(primary_key=True,
+                                    autoincrement='auto')
+    user_id: Mapped[int] = mapped_column(ForeignKey('users.id', ondelete='CASCADE'), index=True)
+    created: Mapped[datetime] = mapped_column(DateTime(timezone=True),
+                                              default=lambda: datetime.datetime.now(tz=tz))
+    amount: Mapped[int] = mapped_column(Integer())
+    balance: Mapped[int] = mapped_column(Integer(), comment='Баланс после операции')
+    kind: Mapped[str] = mapped_column(String(30))
+    link_id: Mapped[int] = mapped_column(Integer(), nullable=True)
+    cash_out_id: Mapped[int] = mapped_column(Integer(), nullable=True)
+    moderator_id: Mapped[int] = mapped_column(Integer(), nullable=True)
 
-if not database_exists(db_url):
-    create_database(db_url)
-Base.metadata.create_all(engine)
+    def __repr__(self):
+        return f'{self.id}. user {self.user_id}: {self.amount} ({self.kind})'
+
+
+class LinkDailyStats(Base):
+    # Сводка роликов по дням. Ведется инкрементально (services/link_stats.py),
+    # из нее строится статистика вместо сканирования links
+    __tablename__ = 'link_daily_stats'
+    __table_args__ = (
+        UniqueConstraint('day', 'link_type', 'owner_id', 'request_id', name='uq_link_daily_stats'),
+    )
+    id: Mapped[int] = mapped_column(primary_key=True,
+                                    autoincrement='auto')
+    day: Mapped[datetime.date] = mapped_column(Date(), index=True)
+    link_type: Mapped[str] = mapped_column(String(20))
+    owner_id: Mapped[int] = mapped_column(ForeignKey('users.id', ondelete='CASCADE'), index=True)
+    request_id: Mapped[int] = mapped_column(ForeignKey('requests.id', ondelete='CASCADE'))
+    links: Mapped[int] = mapped_column(Integer(), default=0)
+    views: Mapped[int] = mapped_column(Integer(), default=0)
+    cost: Mapped[int] = mapped_column(Integer(), default=0)
+
+    def __repr__(self):
+        return f'{self.day} {self.link_type} user {self.owner_id}: {self.links} / {self.views} / {self.cost}'
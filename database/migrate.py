@@ -0,0 +1,77 @@
+"""
+Миграция схемы БД. Берет блокировки ACCESS EXCLUSIVE на users / links / requests,
+поэтому выполняется один раз при старте бота (main.py) или шагом деплоя, а не при импорте моделей:
+    python -m database.migrate
+"""
+from sqlalchemy import text
+from sqlalchemy_utils.functions import database_exists, create_database
+
+from config_data.bot_conf import get_my_loggers
+from database.db import Base, engine, db_url
+from services.link_stats import fill_empty_link_stats
+
+logger, err_log = get_my_loggers()
+
+
+def merge_duplicate_users(conn) -> int:
+    """
+    Склеивает юзеров с одинаковым tg_id (остается запись с меньшим id):
+    переносит ссылки, заявки, выплаты и баланс, дубли удаляет.
+    Нужно перед созданием уникального индекса по tg_id в старых базах.
+    """
+    dups = """
+        WITH dups AS (
+            SELECT id, min(id) OVER (PARTITION BY tg_id) AS keep_id, cash, is_active FROM users
+        )
+    """
+    count = conn.execute(text(dups + 'SELECT count(*) FROM dups WHERE id <> keep_id')).scalar()
+    if not count:
+        return 0
+    logger.warning(f'Найдено дублей юзеров по tg_id: {count}')
+    for table, column in [('links', 'owner_id'), ('requests', 'user_id'),
+                          ('cash_outs', 'user_id'), ('cash_ledger', 'user_id')]:
+        conn.execute(text(dups + f'UPDATE {table} t SET {column} = d.keep_id FROM dups d '
+                                 f'WHERE t.{column} = d.id AND d.id <> d.keep_id'))
+    conn.execute(text(dups + """
+        UPDATE users u SET cash = u.cash + s.cash, is_active = greatest(u.is_active, s.is_active)
+        FROM (SELECT keep_id, sum(cash) AS cash, max(is_active) AS is_active
+              FROM dups WHERE id <> keep_id GROUP BY keep_id) s
+        WHERE u.id = s.keep_id
+    """))
+    conn.execute(text(dups + 'DELETE FROM users u USING dups d WHERE u.id = d.id AND d.id <> d.keep_id'))
+    return count
+
+
+def upgrade_schema():
+    """
+    create_all не меняет существующие таблицы: досоздаем колонки и индексы, которых нет в старых базах
+    """
+    with engine.begin() as conn:
+        merge_duplicate_users(conn)
+        for table in ('users', 'requests', 'links'):
+            conn.execute(text(f'ALTER TABLE {table} ADD COLUMN IF NOT EXISTS updated_at TIMESTAMP WITH TIME ZONE DEFAULT now()'))
+        for table in ('requests', 'links'):
+            conn.execute(text(f'ALTER TABLE {table} ADD COLUMN IF NOT EXISTS claimed_by INTEGER'))
+            conn.execute(text(f'ALTER TABLE {table} ADD COLUMN IF NOT EXISTS claimed_until TIMESTAMP WITH TIME ZONE'))
+        for table in ('links', 'cash_outs'):
+            conn.execute(text(f'ALTER TABLE {table} ADD COLUMN IF NOT EXISTS payout_run_id INTEGER'))
+        # Заменен на ix_links_unpriced (очередь считает неоцененными ролики с view_count = 0)
+        conn.execute(text('DROP INDEX IF EXISTS ix_links_unpaid'))
+        for table in Base.metadata.sorted_tables:
+            for index in table.indexes:
+                index.create(conn, checkfirst=True)
+        fill_empty_link_stats(conn)
+
+
+
+def migrate():
+    """Создает базу и таблицы, если их нет, и досоздает колонки и индексы"""
+    if not database_exists(db_url):
+        create_database(db_url)
+    Base.metadata.create_all(engine)
+    upgrade_schema()
+    logger.info('Схема БД обновлена')
+
+
+if __name__ == '__main__':
+    migrate()
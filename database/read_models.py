@@ -0,0 +1,36 @@
+"""
+Легкие модели для отрисовки меню.
+Экраны получают данные одним запросом только с нужными колонками и раскладывают строки
+в эти классы вместо ORM-объектов со связями. Классы на __slots__: без __dict__
+и без отслеживания сессией.
+"""
+
+
+class ReadModel:
+    __slots__ = ()
+
+    def __init__(self, *values):
+        for name, value in zip(self.__slots__, values):
+            setattr(self, name, value)
+
+    def __repr__(self):
+        fields = ', '.join(f'{name}={getattr(self, name)!r}' for name in self.__slots__)
+        return f'{type(self).__name__}({fields})'
+
+
+class Channel(ReadModel):
+    __slots__ = ('id', 'channel_name', 'cpm')
+
+
+class WebUserStat(ReadModel):
+    """Карточка вэбмастера: итоги по роликам и активные каналы"""
+    __slots__ = ('id', 'username', 'links', 'views', 'cost', 'channels')
+
+
+class LinkCard(ReadModel):
+    __slots__ = ('id', 'link', 'username', 'register_date', 'view_count', 'cost')
+
+
+class RegRow(ReadModel):
+    """Заявка на канал с владельцем"""
+    __slots__ = ('id', 'text', 'user_id', 'username')
@@ -2,20 +2,28 @@ import datetime
 import json
 
 from aiogram import Router, Bot, F
-from aiogram.enums import ChatMemberStatus
 from aiogram.exceptions import TelegramBadRequest
 from aiogram.filters import Command, StateFilter, BaseFilter, or_f
 from aiogram.fsm.context import FSMContext
 from aiogram.fsm.state import StatesGroup, State
-from aiogram.types import Message, CallbackQuery, ReplyKeyboardRemove
+from aiogram.types import Message, CallbackQuery, ReplyKeyboardRemove, ChatMemberUpdated, BufferedInputFile
+from sqlalchemy.ext.asyncio import AsyncSession
+from sqlalchemy.orm import joinedload
 
 from config_data.bot_conf import get_my_loggers, conf
-from database.db import User, LinkMenu, WebUserMenu
+from database.db import User, LinkMenu, WebUserMenu, Request, Link
 from keyboards.keyboards import start_kb, menu_kb, admin_start_kb, custom_kb, not_auth_start_kb
 from lexicon.lexicon import LEXICON
-from services.db_func import get_or_create_user, get_user_from_id, update_user, get_request_from_id, get_link_from_id, \
-    get_cash_out_from_id, get_reg_from_id, create_cash_outs, get_user_request_active
-from services.func import get_unconfirmed_reg, get_users_with_uncofirmed_link
+from middlewares.role import GROUP, MODERATOR, MODERATOR_STATUSES
+from services.cache import member_cache
+from services.db_func_async import get_user_from_id, update_user, get_request_from_id, get_link_from_id, \
+    get_cash_out_from_id, get_reg_from_id, create_cash_outs, get_user_request_active, get_unconfirmed_reg, get_reg_row, \
+    get_users_with_uncofirmed_link
+from services.ledger import change_balance, LINK_PAYOUT, DEACTIVATION_PAYOUT
+from services.link_stats import add_link_stats
+from services.payouts import month_period, preview_payouts, commit_payout_run, report_summary, report_csv
+from services.pricing import read_rows, parse_view_counts, apply_view_counts
+from services.work_queue import claim, claim_next_request, claim_next_link, release, release_all
 
 logger, err_log = get_my_loggers()
 
@@ -29,30 +37,15 @@ class IsAdmin(BaseFilter):
 
 
 class IsFromGroup(BaseFilter):
-    def __init__(self) -> None:
-        self.moderator_chat_id = str(conf.tg_bot.GROUP_ID)
-
-    async def __call__(self, message: Message | CallbackQuery) -> bool:
-        if isinstance(message, CallbackQuery):
-            message = message.message
-        # print(f'Проверка на группу\n'
-        #       f'{message.chat.id} == {self.moderator_chat_id}: {bool(str(message.chat.id) == self.moderator_chat_id)}'
-        #       )
-        return str(message.chat.id) in self.moderator_chat_id
+    """Апдейт из группы модераторов. Роль определяет middlewares/role.py"""
+    async def __call__(self, message: Message | CallbackQuery, role: str) -> bool:
+        return role == GROUP
 
 
 class IsAdminPrivate(BaseFilter):
-    def __init__(self) -> None:
-        self.GROUP_ID = int(conf.tg_bot.GROUP_ID)
-
-    async def __call__(self, message: Message, event_from_user, bot: Bot, *args, **kwargs) -> bool:
-        if isinstance(message, CallbackQuery):
-            message = message.message
-        member = await bot.get_chat_member(chat_id=self.GROUP_ID, user_id=event_from_user.id)
-        status = member.status
-        print(status)
-        is_moderator = status in [ChatMemberStatus.MEMBER, ChatMemberStatus.ADMINISTRATOR, ChatMemberStatus.CREATOR]
-        return is_moderator and message.chat.type == 'private'
+    """Личный чат с участником группы модераторов"""
+    async def __call__(self, message: Message | CallbackQuery, role: str) -> bool:
+        return role == MODERATOR
 
 
 router = Router()
@@ -75,9 +68,19 @@ class FSMLink(StatesGroup):
 #     await state.clear()
 #     await message.answer('Состояние сброшено')
 
+@router.chat_member(F.chat.id == int(conf.tg_bot.GROUP_ID))
+async def group_member_changed(event: ChatMemberUpdated):
+    """Вступление/выход из группы модераторов: обновляем кэш членства без запроса в ТГ"""
+    member = event.new_chat_member
+    member_cache.set(member.user.id, member.status in MODERATOR_STATUSES)
+    logger.debug(f'Членство {member.user.id} в группе модераторов: {member.status}')
+
+
 @router.callback_query(F.data == 'cancel')
-async def operation_in(callback: CallbackQuery, state: FSMContext, bot: Bot):
+async def operation_in(callback: CallbackQuery, state: FSMContext, bot: Bot, session: AsyncSession, user: User):
     logger.debug('chat cancel-start')
+    # Брошенные заявки и ролики сразу доступны другим модераторам, не ждем конца аренды
+    await release_all(session, user.id)
     await callback.message.delete()
     # await callback.message.answer('Режим модератора', reply_markup=ReplyKeyboardRemove())
     await callback.message.answer('Главное меню модератора', reply_markup=admin_start_kb)
@@ -113,85 +116,115 @@ class FSMAdminReg(StatesGroup):
 
 # Заявки на НОВЫЙ КАНАЛ из админки
 @router.callback_query(F.data == 'reg_list')
-async def reg_list(callback: CallbackQuery, state: FSMContext, bot: Bot):
+async def reg_list(callback: CallbackQuery, state: FSMContext, bot: Bot, session: AsyncSession, user: User):
     logger.debug('reg_list')
-    uncofirmed_reg = get_unconfirmed_reg(100)
-    print(uncofirmed_reg)
-    btn = {}
+    # Без заявок, которые сейчас в работе у других модераторов
+    uncofirmed_reg = await get_unconfirmed_reg(session, 100, moderator_id=user.id)
+    btn = {'Взять следующую': 'reg_next'}
     text = 'Заявки:\n'
     for reg in uncofirmed_reg:
         text += f'{reg.id}. {reg.text}\n'
-        btn[f'{reg.id}. {reg.owner.username} {reg.owner.id}'] = f'reg_list:{reg.id}'
+        btn[f'{reg.id}. {reg.username} {reg.user_id}'] = f'reg_list:{reg.id}'
     btn['Отмена'] = 'cancel'
     await callback.message.edit_text(text=text[:4000], reply_markup=custom_kb(1, btn))
 
 
-@router.callback_query(F.data.startswith('reg_list:'))
-async def reg_list2(callback: CallbackQuery, state: FSMContext, bot: Bot):
-    print(callback.data)
-    request_id = int(callback.data.split('reg_list:')[-1])
-    reg = get_request_from_id(request_id)
-    btn = {f'Принять {reg.id} {reg.owner.username}': f'confirm_reg:{reg.id}',
-           f'Отклонить {reg.id} {reg.owner.username}': f'reject_reg:{reg.id}',
+async def show_reg(callback: CallbackQuery, session: AsyncSession, request_id: int):
+    reg = await get_reg_row(session, request_id)
+    btn = {f'Принять {reg.id} {reg.username}': f'confirm_reg:{reg.id}',
+           f'Отклонить {reg.id} {reg.username}': f'reject_reg:{reg.id}',
+           'Следующая заявка': f'reg_next:{reg.id}',
            f'Отмена': 'cancel'}
     text = reg.text
     await callback.message.edit_text(text=text, reply_markup=custom_kb(1, btn))
 
 
+@router.callback_query(F.data.startswith('reg_list:'))
+async def reg_list2(callback: CallbackQuery, state: FSMContext, bot: Bot, session: AsyncSession):
+    print(callback.data)
+    request_id = int(callback.data.split('reg_list:')[-1])
+    # Просмотр не закрепляет заявку: закрепляют Принять / Отклонить
+    await show_reg(callback, session, request_id)
+
+
+@router.callback_query(F.data.startswith('reg_next'))
+async def reg_next(callback: CallbackQuery, state: FSMContext, bot: Bot, session: AsyncSession, user: User):
+    """Следующая свободная заявка из очереди. reg_next:<id> - сначала вернуть текущую в очередь"""
+    logger.debug(callback.data)
+    _, _, current_id = callback.data.partition(':')
+    if current_id:
+        await release(session, Request, int(current_id), user.id)
+    request_id = await claim_next_request(session, user.id)
+    if request_id is None:
+        await callback.message.edit_text('Свободных заявок нет', reply_markup=admin_start_kb)
+        return
+    await show_reg(callback, session, request_id)
+
+
 @router.callback_query(F.data.startswith('reject_reg:'))
-async def reject_reg(callback: CallbackQuery, state: FSMContext, bot: Bot):
+async def reject_reg(callback: CallbackQuery, state: FSMContext, bot: Bot, session: AsyncSession, user: User):
     print(callback.data)
+    request_id = int(callback.data.split('reject_reg:')[-1])
+    if not await claim(session, Request, request_id, user.id):
+        await callback.answer('Заявка в работе у другого модератора', show_alert=True)
+        return
     await callback.message.delete()
     await state.set_state(FSMAdminReg.reject)
-    request_id = int(callback.data.split('reject_reg:')[-1])
     await state.update_data(request_id=request_id)
     await callback.message.answer('Укажите причину:')
 
 
 @router.message(StateFilter(FSMAdminReg.reject))
-async def reject(message: Message, state: FSMContext, bot: Bot):
+async def reject(message: Message, state: FSMContext, bot: Bot, session: AsyncSession):
     reject_text = message.text.strip()
     data = await state.get_data()
     request_id = data['request_id']
-    request = get_request_from_id(request_id)
-    client = get_user_from_id(request.user_id)
-    request.set('status', -1)
-    request.set('reject_text', reject_text)
-    reg = get_reg_from_id(request_id)
+    request = await get_request_from_id(session, request_id)
+    client = await get_user_from_id(session, request.user_id)
+    if not await request.aupdate(session, expect={'status': 0}, status=-1, reject_text=reject_text):
+        await state.clear()
+        await message.answer(f'Заявка {request_id} уже обработана', reply_markup=admin_start_kb)
+        return
+    reg = await get_reg_from_id(session, request_id)
     msg = Message(**json.loads(reg.msg))
     msg = Message.model_validate(msg).as_(bot)
     await state.clear()
     await bot.send_message(chat_id=client.tg_id, text=f'Ваша заяка на канал № {request_id} отклонена:\n{reject_text}')
-    await message.answer(text=f'Заявка {reg.id} {reg.owner.username} отклонена\n', reply_markup=admin_start_kb)
+    await message.answer(text=f'Заявка {reg.id} {client.username} отклонена\n', reply_markup=admin_start_kb)
     await state.clear()
     await msg.edit_text(text=msg.text + f'<b>\n\nОтклонено {message.from_user.username or message.from_user.id}\n{reject_text}</b>')
 
 
 @router.callback_query(F.data.startswith('confirm_reg:'))
-async def req_confirm(callback: CallbackQuery, state: FSMContext, bot: Bot):
-    await callback.message.delete()
+async def req_confirm(callback: CallbackQuery, state: FSMContext, bot: Bot, session: AsyncSession, user: User):
     logger.debug(callback.data)
     request_id = int(callback.data.split('confirm_reg:')[-1])
+    if not await claim(session, Request, request_id, user.id):
+        await callback.answer('Заявка в работе у другого модератора', show_alert=True)
+        return
+    await callback.message.delete()
     await state.update_data(request_id=request_id)
-    request = get_request_from_id(request_id)
-    user = request.owner
-    await callback.message.answer(f'Укажитe CPM для заявки {request_id} юзера {user}')
+    request = await get_request_from_id(session, request_id, joinedload(Request.owner))
+    client = request.owner
+    await callback.message.answer(f'Укажитe CPM для заявки {request_id} юзера {client}')
     await state.set_state(FSMAdminReg.set_cpm)
 
 
 @router.message(StateFilter(FSMAdminReg.set_cpm))
-async def select_cpm(message: Message, state: FSMContext, bot: Bot):
+async def select_cpm(message: Message, state: FSMContext, bot: Bot, session: AsyncSession):
     try:
         cpm = message.text.strip()
         cpm = float(cpm)
         await state.update_data(cpm=cpm)
         data = await state.get_data()
         request_id = data.get('request_id')
-        request = get_request_from_id(request_id)
+        request = await get_request_from_id(session, request_id, joinedload(Request.owner))
+        if not await request.aupdate(session, expect={'status': 0}, status=1, cpm=cpm):
+            await state.clear()
+            await message.answer(f'Заявка {request_id} уже обработана')
+            return
         user = request.owner
-        update_user(user, {'is_active': 1})
-        request.set('status', 1)
-        request.set('cpm', cpm)
+        await update_user(session, user, {'is_active': 1})
         await bot.send_message(chat_id=user.tg_id, text=f'Ваша заяка  {request.id} одобрена')
         # msg = Message(**json.loads(request.msg))
         # msg = Message.model_validate(msg).as_(bot)
@@ -242,20 +275,22 @@ async def in_confirm(callback: CallbackQuery, state: FSMContext, bot: Bot):
 
 
 @router.message(StateFilter(FSMConfirmRequest.select_cpm))
-async def select_cpm(message: Message, state: FSMContext, bot: Bot):
+async def select_cpm(message: Message, state: FSMContext, bot: Bot, session: AsyncSession):
     try:
         cpm = message.text.strip()
         cpm = float(cpm)
         await state.update_data(cpm=cpm)
         data = await state.get_data()
         request_id = data.get('request_id')
-        request = get_request_from_id(request_id)
-        user = get_user_from_id(request.user_id)
+        request = await get_request_from_id(session, request_id)
+        user = await get_user_from_id(session, request.user_id)
         data = await state.get_data()
         cpm = data.get('cpm')
-        update_user(user, {'is_active': 1})
-        request.set('status', 1)
-        request.set('cpm', cpm)
+        if not await request.aupdate(session, expect={'status': 0}, status=1, cpm=cpm):
+            await state.clear()
+            await message.answer(f'Заявка {request_id} уже обработана')
+            return
+        await update_user(session, user, {'is_active': 1})
         await bot.send_message(chat_id=user.tg_id,
                                text=f'Мы готовы предложить Вам сотрудничество по ставке {cpm} рублей за тысячу просмотров с каналом: {request.channel_name}\n\nТеперь, когда Вы будете выкладывать видео, вы должны в тот же день скидывать видео в этот чат. Для этого нажмите на кнопку “Отправить ссылку”.')
         await bot.send_message(chat_id=user.tg_id,
@@ -316,7 +351,7 @@ async def select_cpm(message: Message, state: FSMContext, bot: Bot):
 
 
 @router.callback_query(F.data.startswith('reject_user_'))
-async def reject(callback: CallbackQuery, state: FSMContext, bot: Bot):
+async def reject(callback: CallbackQuery, state: FSMContext, bot: Bot, session: AsyncSession):
     await state.set_state(FSMAdmin.reject)
     request_id = int(callback.data.split('reject_user_')[-1])
     await state.update_data(request_id=request_id, msg=callback.message)
@@ -326,11 +361,13 @@ async def reject(callback: CallbackQuery, state: FSMContext, bot: Bot):
     data = await state.get_data()
     msg = data['msg']
     request_id = data['request_id']
-    request = get_request_from_id(request_id)
-    client = get_user_from_id(request.user_id)
-    request.set('status', -1)
+    request = await get_request_from_id(session, request_id)
+    client = await get_user_from_id(session, request.user_id)
     reject_text = ''
-    request.set('reject_text', reject_text)
+    if not await request.aupdate(session, expect={'status': 0}, status=-1, reject_text=reject_text):
+        await state.clear()
+        await callback.answer(f'Заявка {request_id} уже обработана')
+        return
     await bot.send_message(chat_id=client.tg_id, text=f'К сожалению мы не готовы предложить вам сотрудничество по каналу {request.channel_name}')
     await msg.edit_text(text=msg.text + f'<b>\n\nОтклонено {callback.message.from_user.username or callback.message.from_user.id}\n{reject_text}</b>')
     await state.clear()
@@ -343,16 +380,16 @@ class FSMCashOut(StatesGroup):
 
 
 @router.callback_query(F.data.startswith('cash_out_confirm:'))
-async def cash_conf(callback: CallbackQuery, state: FSMContext, bot: Bot):
+async def cash_conf(callback: CallbackQuery, state: FSMContext, bot: Bot, session: AsyncSession, user: User):
     await callback.message.delete()
     cash_out_id = int(callback.data.split('cash_out_confirm:')[-1])
-    cash_out = get_cash_out_from_id(cash_out_id)
-    cash_out.set('status', 1)
-    moderator = get_or_create_user(callback.from_user)
-    cash_out.set('moderator_id', moderator.id)
+    cash_out = await get_cash_out_from_id(session, cash_out_id)
+    if not await cash_out.aupdate(session, expect={'status': 0}, status=1, moderator_id=user.id):
+        await callback.message.answer(f'Заявка № {cash_out_id} уже обработана')
+        return
     await callback.message.answer(f'Выплата по заявке № {cash_out_id} подтверждена')
     # Отправка клиенту
-    client = get_user_from_id(cash_out.user_id)
+    client = await get_user_from_id(session, cash_out.user_id)
     # new_cash = client.cash - cash_out.cost
     text = f'Ваша заявка № {cash_out_id} на сумму {cash_out.cost} подтверждена\n'
     text += f'сумма {cash_out.cost} рублей будет переведена на ваш кошелек {cash_out.trc20} по курсу местного банка в течении 5 рабочих дней'
@@ -374,20 +411,21 @@ async def cash_conf(callback: CallbackQuery, state: FSMContext, bot: Bot):
 
 
 @router.message(StateFilter(FSMCashOut.reject))
-async def cash_rej_verdict(message: Message, state: FSMContext, bot: Bot):
+async def cash_rej_verdict(message: Message, state: FSMContext, bot: Bot, session: AsyncSession, user: User):
     data = await state.get_data()
     msg = data['msg']
     verdict = message.text.strip()
     await state.update_data(verdict=verdict)
     cash_out_id = data['cash_out_id']
-    cash_out = get_cash_out_from_id(cash_out_id)
-    cash_out.set('status', -1)
-    moderator = get_or_create_user(message.from_user)
-    cash_out.set('moderator_id', moderator.id)
-    cash_out.set('reject_text', verdict)
+    cash_out = await get_cash_out_from_id(session, cash_out_id)
+    if not await cash_out.aupdate(session, expect={'status': 0}, status=-1, moderator_id=user.id,
+                                  reject_text=verdict):
+        await state.clear()
+        await message.answer(f'Заявка № {cash_out_id} уже обработана')
+        return
     await message.answer(f'Выплата по заявке № {cash_out_id} отклонена')
     # Отправка клиенту
-    client = get_user_from_id(cash_out.user_id)
+    client = await get_user_from_id(session, cash_out.user_id)
     await bot.send_message(chat_id=client.tg_id,
                            text=f'Ваша заявка № {cash_out_id} на сумму {cash_out.cost} ОТКЛОНЕНА:\n{verdict}')
     # Меняем сообщение в группе
@@ -396,6 +434,58 @@ async def cash_rej_verdict(message: Message, state: FSMContext, bot: Bot):
 # КОНЕЦ Заявки на вывод средств **********************
 
 
+# Выплаты вэбмастерам за месяц одной операцией
+@router.callback_query(F.data == 'payouts')
+async def payouts_menu(callback: CallbackQuery, state: FSMContext, bot: Bot):
+    kb = {'Прошлый месяц': 'payout_preview:1', 'Текущий месяц': 'payout_preview:0', 'Назад': 'cancel'}
+    await callback.message.edit_text('Выплата за период', reply_markup=custom_kb(1, kb))
+
+
+async def send_payout_preview(message: Message, state: FSMContext, session: AsyncSession, months_ago: int,
+                              header=''):
+    start, end = month_period(months_ago)
+    _, report = await preview_payouts(session, start, end)
+    total = int(report.loc[report['payout'] > 0, 'payout'].sum())
+    await state.update_data(payout_total=total)
+    kb = {'Провести выплату': f'payout_commit:{months_ago}', 'Отмена': 'cancel'} if total else {'Назад': 'cancel'}
+    await message.answer_document(
+        BufferedInputFile(report_csv(report), filename=f'payouts_{start:%Y_%m}.csv'),
+        caption=header + report_summary(report, start, end),
+        reply_markup=custom_kb(1, kb),
+    )
+
+
+@router.callback_query(F.data.startswith('payout_preview:'))
+async def payout_preview(callback: CallbackQuery, state: FSMContext, bot: Bot, session: AsyncSession):
+    logger.debug(callback.data)
+    await callback.message.delete()
+    months_ago = int(callback.data.split(':')[1])
+    await send_payout_preview(callback.message, state, session, months_ago)
+
+
+@router.callback_query(F.data.startswith('payout_commit:'))
+async def payout_commit(callback: CallbackQuery, state: FSMContext, bot: Bot, session: AsyncSession, user: User):
+    logger.debug(callback.data)
+    await callback.message.edit_reply_markup(reply_markup=None)
+    months_ago = int(callback.data.split(':')[1])
+    data = await state.get_data()
+    if data.get('payout_total') is None:
+        await send_payout_preview(callback.message, state, session, months_ago)
+        return
+    start, end = month_period(months_ago)
+    run, report = await commit_payout_run(session, start, end, moderator_id=user.id,
+                                          expected_total=data['payout_total'])
+    if run is None:
+        # Кто-то провел выплату или оценил ролики после предпросмотра - показываем новый расчет
+        await send_payout_preview(callback.message, state, session, months_ago,
+                                  header='Данные изменились, проверьте расчет еще раз\n\n')
+        return
+    await state.update_data(payout_total=None)
+    await callback.message.answer(
+        f'Выплата {run.id} проведена: {run.users} вэбмастеров, {run.links} роликов, {run.total} рублей',
+        reply_markup=admin_start_kb)
+
+
 # -----------------Webuser--------------------
 
 
@@ -404,21 +494,22 @@ class FSMWebUserMenu(StatesGroup):
     change_view = State()
     change_cpm = State()
     deactivate = State()
+    bulk_views = State()
 
 # -----Просмотр инфо по вэбмастерам-----
 @router.callback_query(F.data == 'active_web')
-async def send_link(callback: CallbackQuery, state: FSMContext, bot: Bot):
+async def send_link(callback: CallbackQuery, state: FSMContext, bot: Bot, session: AsyncSession):
     # await callback.message.delete()
     logger.debug('active_web')
-    menu = WebUserMenu()
-    text = menu.text()
+    menu = WebUserMenu(session)
+    text = await menu.text()
     await state.set_state(FSMWebUserMenu.menu)
     await state.update_data(page=0)
-    await callback.message.edit_text(text=text, reply_markup=menu.nav_menu())
+    await callback.message.edit_text(text=text, reply_markup=await menu.nav_menu())
 
 
 @router.callback_query(F.data.in_(['<<', 'back', '>>']))
-async def active_web_n(callback: CallbackQuery, state: FSMContext, bot: Bot):
+async def active_web_n(callback: CallbackQuery, state: FSMContext, bot: Bot, session: AsyncSession):
     logger.debug(callback.data)
     data = await state.get_data()
     print('data', data)
@@ -428,19 +519,19 @@ async def active_web_n(callback: CallbackQuery, state: FSMContext, bot: Bot):
     elif callback.data == '>>':
         page += 1
     await state.update_data(page=page)
-    menu = WebUserMenu()
-    await callback.message.edit_reply_markup(reply_markup=menu.nav_menu(page=page))
+    menu = WebUserMenu(session)
+    await callback.message.edit_reply_markup(reply_markup=await menu.nav_menu(page=page))
 
 
 @router.callback_query(F.data.startswith('active_web_n:'))
-async def active_web_n(callback: CallbackQuery, state: FSMContext, bot: Bot):
+async def active_web_n(callback: CallbackQuery, state: FSMContext, bot: Bot, session: AsyncSession):
     logger.debug(callback.data)
     user_id = int(callback.data.split('active_web_n:')[1])
     logger.debug('active_web')
-    menu = WebUserMenu(user_id)
-    text = menu.user_stat()
+    menu = WebUserMenu(session, user_id)
+    text = await menu.user_stat()
     await state.update_data(user_id=user_id)
-    await callback.message.edit_text(text=text, reply_markup=menu.nav_menu(user_id))
+    await callback.message.edit_text(text=text, reply_markup=await menu.nav_menu(user_id))
 # -----Конец блока просмотр инфо по вэбмастерам-----
 
 
@@ -455,13 +546,13 @@ async def active_web_n(callback: CallbackQuery, state: FSMContext, bot: Bot):
 
 
 @router.callback_query(F.data == 'videos')
-async def videos(callback: CallbackQuery, state: FSMContext, bot: Bot):
-    """Ролики юзеров у которых cost=0"""
+async def videos(callback: CallbackQuery, state: FSMContext, bot: Bot, session: AsyncSession, user: User):
+    """Ролики юзеров у которых view_count=0"""
     logger.debug(callback.data)
     await state.clear()
     await state.set_state(FSMWebUserMenu.menu)
-    users = get_users_with_uncofirmed_link()
-    btn = {}
+    users = await get_users_with_uncofirmed_link(session, moderator_id=user.id)
+    btn = {'Взять следующий ролик': 'link_next', 'Загрузить просмотры файлом': 'bulk_views'}
     for user in users:
         btn[f'{user.id}. {user.username}'] = f'show_user_links:{user.id}'
     await callback.message.edit_text('Выберите юзера', reply_markup=custom_kb(1, btn))
@@ -479,7 +570,7 @@ async def show_user_links(callback: CallbackQuery, state: FSMContext, bot: Bot):
 
 
 @router.callback_query(F.data.startswith('links_period:'))
-async def links_period(callback: CallbackQuery, state: FSMContext, bot: Bot):
+async def links_period(callback: CallbackQuery, state: FSMContext, bot: Bot, session: AsyncSession):
     logger.debug(callback.data)
     print(callback.data.split(':'))
     link_period = int(callback.data.split(':')[1])
@@ -487,51 +578,78 @@ async def links_period(callback: CallbackQuery, state: FSMContext, bot: Bot):
     user_id = data.get('user_id') or 0
     if len(callback.data.split(':')) == 3:
         user_id = int(callback.data.split(':')[2])
-    link_menu = LinkMenu(link_period=link_period, user_id=user_id)
-    text = link_menu.text()
+    link_menu = LinkMenu(session, link_period=link_period, user_id=user_id)
+    text = await link_menu.text()
     page = 0
-    kb = link_menu.nav_menu(page=page)
+    kb = await link_menu.nav_menu(page=page)
     await state.update_data(link_period=link_period, user_id=user_id, page=0)
     await callback.message.edit_text(text=text, reply_markup=kb)
 
 
 @router.callback_query(F.data.in_(['link<<', 'link_back', 'link>>']))
-async def active_web_n(callback: CallbackQuery, state: FSMContext, bot: Bot):
+async def active_web_n(callback: CallbackQuery, state: FSMContext, bot: Bot, session: AsyncSession):
     logger.debug(callback.data)
     data = await state.get_data()
     link_period = data.get('link_period')
+    user_id = data.get('user_id') or 0
     page = data.get('page')
     if callback.data == 'link<<':
         page -= 1
     elif callback.data == 'link>>':
         page += 1
     await state.update_data(page=page)
-    menu = LinkMenu(link_period=link_period)
-    await callback.message.edit_reply_markup(reply_markup=menu.nav_menu(page=page))
+    menu = LinkMenu(session, link_period=link_period, user_id=user_id)
+    # В тексте только ролики страницы - меняем и текст, и кнопки (одна выборка на оба)
+    text = await menu.text(page=page)
+    await callback.message.edit_text(text=text, reply_markup=await menu.nav_menu(page=page))
 
 
 # Корректировка ссылки
 @router.callback_query(F.data.startswith('links_id:'))
-async def links_period(callback: CallbackQuery, state: FSMContext, bot: Bot):
+async def links_period(callback: CallbackQuery, state: FSMContext, bot: Bot, session: AsyncSession):
     logger.debug(callback.data)
     data = await state.get_data()
     link_id = int(callback.data.split('links_id:')[1])
+    # Просмотр не закрепляет ролик: закрепляет link_view_change
+    await state.update_data(from_queue=False)
     link_period = data.get('link_period')
-    link = get_link_from_id(link_id)
-    print(data)
-    link_menu = LinkMenu(n=link_id, **data)
-    text = link_menu.link_stat(link_id)
+    link_menu = LinkMenu(session, n=link_id, **data)
+    text = await link_menu.link_stat(link_id)
     print(data)
-    menu = link_menu.nav_menu()
+    menu = await link_menu.nav_menu()
     await callback.message.edit_text(text=text, reply_markup=menu)
 
 
+@router.callback_query(F.data.startswith('link_next'))
+async def link_next(callback: CallbackQuery, state: FSMContext, bot: Bot, session: AsyncSession, user: User):
+    """Следующий свободный ролик без выплаты. link_next:<id> - сначала вернуть текущий в очередь"""
+    logger.debug(callback.data)
+    _, _, current_id = callback.data.partition(':')
+    if current_id:
+        await release(session, Link, int(current_id), user.id)
+    link_id = await claim_next_link(session, user.id)
+    if link_id is None:
+        await callback.message.edit_text('Свободных роликов без выплат нет', reply_markup=admin_start_kb)
+        return
+    # После оценки change_view вернет к очереди, а не к меню периода
+    await state.update_data(from_queue=True)
+    link_menu = LinkMenu(session, n=link_id)
+    text = await link_menu.link_stat(link_id)
+    btn = {'Изменить количество просмотров': f'link_view_change:{link_id}',
+           'Следующий ролик': f'link_next:{link_id}',
+           'Отмена': 'cancel'}
+    await callback.message.edit_text(text=text, reply_markup=custom_kb(1, btn))
+
+
 @router.callback_query(F.data.startswith('link_view_change:'))
-async def link_view_change(callback: CallbackQuery, state: FSMContext, bot: Bot):
+async def link_view_change(callback: CallbackQuery, state: FSMContext, bot: Bot, session: AsyncSession, user: User):
     logger.debug(callback.data)
-    await callback.message.delete()
     link_id = int(callback.data.split('link_view_change:')[1])
-    link = get_link_from_id(link_id)
+    if not await claim(session, Link, link_id, user.id):
+        await callback.answer('Ролик в работе у другого модератора', show_alert=True)
+        return
+    await callback.message.delete()
+    link = await get_link_from_id(session, link_id, joinedload(Link.owner), joinedload(Link.request))
     if link.view_count:
         await callback.message.delete()
         await callback.message.answer('Просмотры уже назначены')
@@ -543,7 +661,7 @@ async def link_view_change(callback: CallbackQuery, state: FSMContext, bot: Bot)
 
 
 @router.message(StateFilter(FSMWebUserMenu.change_view))
-async def change_view(message: Message, state: FSMContext, bot: Bot):
+async def change_view(message: Message, state: FSMContext, bot: Bot, session: AsyncSession, user: User):
     """Обработка установки количества просмотров"""
     logger.debug(change_view)
     try:
@@ -552,16 +670,20 @@ async def change_view(message: Message, state: FSMContext, bot: Bot):
         cpm = data.get('cpm')
         link_id = data.get('link_id')
         cost = int(view_count / 1000 * cpm)
-        link = get_link_from_id(link_id)
-        link.set('view_count', view_count)
-        link.set('cost', cost)
-        user = link.owner
-        user.set('cash', user.cash + cost)
-        link_period = data.get('link_period')
-        user_id = data.get('user_id')
-        page = data.get('page', 0)
-        link_menu = LinkMenu(link_period=link_period, user_id=user_id)
-        kb = link_menu.nav_menu(page=page)
+        link = await get_link_from_id(session, link_id)
+        if not await link.aupdate(session, expect={'view_count': 0}, view_count=view_count, cost=cost):
+            await message.answer('Просмотры уже назначены')
+            return
+        await change_balance(session, link.owner_id, cost, LINK_PAYOUT, link_id=link.id, moderator_id=user.id)
+        await add_link_stats(session, link, views=view_count, cost=cost)
+        if data.get('from_queue'):
+            kb = custom_kb(1, {'Следующий ролик': 'link_next', 'Отмена': 'cancel'})
+        else:
+            link_period = data.get('link_period')
+            user_id = data.get('user_id')
+            page = data.get('page', 0)
+            link_menu = LinkMenu(session, link_period=link_period, user_id=user_id)
+            kb = await link_menu.nav_menu(page=page)
         await message.answer(f'Просмотры для ролика {link_id} установлены. Стоимость: {cost} рублей',
                              # reply_markup=admin_start_kb
                              reply_markup=kb
@@ -574,15 +696,49 @@ async def change_view(message: Message, state: FSMContext, bot: Bot):
         await message.answer(f'error: {str(err)}')
 
 
+# Пакетное назначение просмотров
+@router.callback_query(F.data == 'bulk_views')
+async def bulk_views(callback: CallbackQuery, state: FSMContext, bot: Bot):
+    logger.debug(callback.data)
+    await state.set_state(FSMWebUserMenu.bulk_views)
+    await callback.message.edit_text(
+        'Отправьте CSV или XLSX с колонками: id ролика, просмотры.\n'
+        'Или вставьте строки вида "id просмотры", по одной на ролик.\n'
+        'Стоимость считается по CPM канала ролика',
+        reply_markup=custom_kb(1, {'Отмена': 'cancel'}))
+
+
+@router.message(StateFilter(FSMWebUserMenu.bulk_views), or_f(F.document, F.text))
+async def bulk_views_file(message: Message, state: FSMContext, bot: Bot, session: AsyncSession, user: User):
+    if message.document:
+        data = (await bot.download(message.document)).getvalue()
+        filename = message.document.file_name or ''
+    else:
+        data = message.text.encode()
+        filename = ''
+    try:
+        counts, errors = parse_view_counts(read_rows(data, filename))
+    except Exception as err:
+        logger.warning(f'Не удалось прочитать файл просмотров {filename}: {err}')
+        await message.answer('Не удалось прочитать файл. Нужен CSV (UTF-8) или XLSX')
+        return
+    if errors:
+        await message.answer('Ничего не изменено, исправьте и отправьте снова:\n' + '\n'.join(errors))
+        return
+    result = await apply_view_counts(session, counts, moderator_id=user.id)
+    await state.clear()
+    await message.answer(result.summary()[:4000], reply_markup=admin_start_kb)
+
+
 # Смена CPM
 @router.callback_query(F.data.startswith('cpm_select:'))
-async def cpm_select(callback: CallbackQuery, state: FSMContext, bot: Bot):
+async def cpm_select(callback: CallbackQuery, state: FSMContext, bot: Bot, session: AsyncSession):
     logger.debug(callback.data)
     user_id = int(callback.data.split('cpm_select:')[1])
-    user = get_user_from_id(user_id)
+    user = await get_user_from_id(session, user_id)
     await state.update_data(user_id=user_id)
     text = f'Каналы пользователя {user}:\n\n'
-    channels = get_user_request_active(user.id)
+    channels = await get_user_request_active(session, user.id)
     kb = {}
     for channel in channels:
         text += f'{channel.id}. {channel.channel_name}\n'
@@ -591,25 +747,25 @@ async def cpm_select(callback: CallbackQuery, state: FSMContext, bot: Bot):
 
 
 @router.callback_query(F.data.startswith('change_cpm:'))
-async def change_cpm(callback: CallbackQuery, state: FSMContext, bot: Bot):
+async def change_cpm(callback: CallbackQuery, state: FSMContext, bot: Bot, session: AsyncSession):
     logger.debug(callback.data)
     await callback.message.delete()
     request_id = int(callback.data.split('change_cpm:')[1])
-    request = get_request_from_id(request_id)
+    request = await get_request_from_id(session, request_id, joinedload(Request.owner))
     await state.update_data(user_id=request.owner.id, request_id=request_id)
     await callback.message.answer(f'Укажите новый CPM для канала {request.channel_name} пользователя {request.owner}')
     await state.set_state(FSMWebUserMenu.change_cpm)
 
 
 @router.message(StateFilter(FSMWebUserMenu.change_cpm))
-async def change_cpm(message: Message, state: FSMContext, bot: Bot):
+async def change_cpm(message: Message, state: FSMContext, bot: Bot, session: AsyncSession):
     logger.debug(change_view)
     try:
         new_cpm = float(message.text.strip())
         data = await state.get_data()
         request_id = data.get('request_id')
-        request = get_request_from_id(request_id)
-        request.set('cpm', new_cpm)
+        request = await get_request_from_id(session, request_id, joinedload(Request.owner))
+        await request.aupdate(session, cpm=new_cpm)
         await message.answer(f'Новый СРМ для канала {request.channel_name} пользователя {request.owner.username} установлен на {new_cpm}',
                              reply_markup=admin_start_kb
                              )
@@ -636,10 +792,10 @@ async def change_cpm(message: Message, state: FSMContext, bot: Bot):
 # Отключение КАНАЛА мастера
 
 @router.callback_query(F.data.startswith('deactivate:'))
-async def deactivate(callback: CallbackQuery, state: FSMContext, bot: Bot):
+async def deactivate(callback: CallbackQuery, state: FSMContext, bot: Bot, session: AsyncSession):
     logger.debug(callback.data)
     user_id = int(callback.data.split('deactivate:')[1])
-    channels = get_user_request_active(user_id)
+    channels = await get_user_request_active(session, user_id)
     kb = {}
     text = f'Каналы:\n\n'
     for channel in channels:
@@ -650,10 +806,10 @@ async def deactivate(callback: CallbackQuery, state: FSMContext, bot: Bot):
 
 
 @router.callback_query(F.data.startswith('deactivatechannel:'))
-async def deactivate(callback: CallbackQuery, state: FSMContext, bot: Bot):
+async def deactivate(callback: CallbackQuery, state: FSMContext, bot: Bot, session: AsyncSession):
     logger.debug(callback.data)
     request_id = int(callback.data.split('deactivatechannel:')[1])
-    request = get_request_from_id(request_id)
+    request = await get_request_from_id(session, request_id)
     await state.update_data(request_id=request_id)
     kb = {
         'Отключить без выплаты': 'deactivate_0',
@@ -705,14 +861,14 @@ async def deactivate(callback: CallbackQuery, state: FSMContext, bot: Bot):
 #     user.set('is_active', 0)
 
 @router.callback_query(F.data.startswith('deactivate_'))
-async def deactivate_(callback: CallbackQuery, state: FSMContext, bot: Bot):
+async def deactivate_(callback: CallbackQuery, state: FSMContext, bot: Bot, session: AsyncSession):
     """Деативация канала свыплатой или без"""
     logger.debug(callback.data)
     await callback.message.delete()
     mode = callback.data.split('deactivate_')[1]
     data = await state.get_data()
     request_id = data.get('request_id')
-    request = get_request_from_id(request_id)
+    request = await get_request_from_id(session, request_id, joinedload(Request.owner))
     trc20 = ''
     if mode == '1' and request.owner.cash > 0:
         # Создаем запрос на вывод средств
@@ -730,7 +886,9 @@ async def deactivate_(callback: CallbackQuery, state: FSMContext, bot: Bot):
         # cash_out = get_cash_out_from_id(cash_out_id)
         # cash_out.set('msg', msg.model_dump_json())
     else:
-        request.set('status', -1)
+        if not await request.aupdate(session, expect={'status': 1}, status=-1):
+            await callback.message.answer(f'Канал {request.id} {request.channel_name} уже отключен')
+            return
         await bot.send_message(chat_id=request.owner.tg_id,
                                text=f'Ваш канал {request.id} {request.channel_name} отключили от работы', reply_markup=not_auth_start_kb)
         await callback.message.answer(f'Канал {request.id} {request.channel_name} пользователя {request.owner.username} отключен')
@@ -738,43 +896,47 @@ async def deactivate_(callback: CallbackQuery, state: FSMContext, bot: Bot):
 
 # Деактивация юзера
 @router.callback_query(F.data.startswith('deactivateuser:'))
-async def deactivate(callback: CallbackQuery, state: FSMContext, bot: Bot):
+async def deactivate(callback: CallbackQuery, state: FSMContext, bot: Bot, session: AsyncSession):
     await callback.message.delete()
     logger.debug(callback.data)
     user_id = int(callback.data.split('deactivateuser:')[1])
-    user = get_user_from_id(user_id)
+    user = await get_user_from_id(session, user_id)
     await state.update_data(user_id=user_id)
     kb = {'Отключить без выплаты': 'deactivateuser_0', 'Отключить и рассчитать': 'deactivateuser_1'}
     await callback.message.answer(f'Деактивация пользователя {user.username}.\nВыберите режим', reply_markup=custom_kb(1, kb))
 
 
 @router.callback_query(F.data.startswith('deactivateuser_'))
-async def deactivate_(callback: CallbackQuery, state: FSMContext, bot: Bot):
+async def deactivate_(callback: CallbackQuery, state: FSMContext, bot: Bot, session: AsyncSession, user: User):
     """Деативация канала свыплатой или без"""
     logger.debug(callback.data)
     await callback.message.delete()
     mode = callback.data.split('deactivateuser_')[1]
     data = await state.get_data()
     user_id = data.get('user_id')
-    user = get_user_from_id(user_id)
+    client = await get_user_from_id(session, user_id)
     trc20 = ''
-    if mode == '1' and user.cash > 0:
+    if mode == '1' and client.cash > 0:
         # Создаем запрос на вывод средств
-        cash = user.cash
-        trc20 = user.trc20
-        user.set('cash', 0)
-        cash_out_id = create_cash_outs(user.id, cash, trc20)
+        cash = client.cash
+        trc20 = client.trc20
+        entry = await change_balance(session, client.id, -cash, DEACTIVATION_PAYOUT, moderator_id=user.id)
+        if not entry:
+            await callback.message.answer(f'Баланс пользователя {client.username} изменился, повторите деактивацию')
+            return
+        cash_out_id = await create_cash_outs(session, client.id, cash, trc20)
+        entry.cash_out_id = cash_out_id
         btn = {'Подтвердить': f'cash_out_confirm:{cash_out_id}',
                'Отклонить': f'cash_out_reject:{cash_out_id}'}
-        text = f'Заявка при ДЕАКТИВАЦИИ№ {cash_out_id} на вывод {cash} р. от @{user.username or user.tg_id} на кошелек {trc20}'
+        text = f'Заявка при ДЕАКТИВАЦИИ№ {cash_out_id} на вывод {cash} р. от @{client.username or client.tg_id} на кошелек {trc20}'
         msg = await bot.send_message(chat_id=conf.tg_bot.GROUP_ID, text=text, reply_markup=custom_kb(2, btn))
-        await bot.send_message(chat_id=user.tg_id, text=f'Вас отключили от работы, ждите последней выплаты в сумме {cash} на кошелек {trc20}')
-        await callback.message.answer(f'Пользователь {user.username} деактивирован с выплатой')
-        cash_out = get_cash_out_from_id(cash_out_id)
-        cash_out.set('msg', msg.model_dump_json())
+        await bot.send_message(chat_id=client.tg_id, text=f'Вас отключили от работы, ждите последней выплаты в сумме {cash} на кошелек {trc20}')
+        await callback.message.answer(f'Пользователь {client.username} деактивирован с выплатой')
+        cash_out = await get_cash_out_from_id(session, cash_out_id)
+        cash_out.msg = msg.model_dump_json()
     else:
-        await bot.send_message(chat_id=user.tg_id,
+        await bot.send_message(chat_id=client.tg_id,
                                text=f'Вас отключили от работы без последующих вознаграждений', reply_markup=not_auth_start_kb)
-        await callback.message.answer(f'Пользователь {user.username} деактивирован без выплаты')
+        await callback.message.answer(f'Пользователь {client.username} деактивирован без выплаты')
 
-    user.set('is_active', 0)
\ No newline at end of file
+    await client.aupdate(session, is_active=0)
@@ -6,12 +6,13 @@ from aiogram.fsm.state import StatesGroup, State
 from aiogram.types import CallbackQuery, Message, URLInputFile, ReplyKeyboardRemove
 
 from aiogram.fsm.context import FSMContext
+from sqlalchemy.ext.asyncio import AsyncSession
 
 from config_data.bot_conf import get_my_loggers, conf
 from database.db import User
 from keyboards.keyboards import start_kb, contact_kb, admin_start_kb, custom_kb, menu_kb, not_auth_start_kb
 from lexicon.lexicon import LEXICON
-from services.db_func import get_or_create_user, update_user, create_request, get_request_from_id
+from services.db_func_async import update_user, create_request, get_request_from_id
 
 
 logger, err_log = get_my_loggers()
@@ -102,12 +103,10 @@ async def operation_in(callback: CallbackQuery, state: FSMContext, bot: Bot):
 
 @router.message(F.text == 'Меню')
 @router.message(Command(commands=["start"]))
-async def process_start_command(message: Message, state: FSMContext):
+async def process_start_command(message: Message, state: FSMContext, user: User):
     logger.debug('new')
     try:
         await state.clear()
-        tg_user = message.from_user
-        user: User = get_or_create_user(tg_user)
         if not user.is_active:
             await state.set_state(FSMAnket.anket)
             await state.update_data(question_num=0)
@@ -230,20 +229,19 @@ def format_request(user, answers):
 
 
 @router.callback_query(StateFilter(FSMAnket.confirm), F.data == 'confirm')
-async def in_confirm(callback: CallbackQuery, state: FSMContext, bot: Bot):
+async def in_confirm(callback: CallbackQuery, state: FSMContext, bot: Bot, session: AsyncSession, user: User):
     try:
         await callback.message.delete_reply_markup()
 
-        user = get_or_create_user(callback.from_user)
 
         text = format_request(user, FSMAnket.answers)
         source = FSMAnket.answers[1]
         channel_name = FSMAnket.answers[3]
-        request_id = create_request(user, text, source, channel_name)
+        request_id = await create_request(session, user, text, source, channel_name)
         btn = {'Принять': f'confirm_user_{request_id}', 'Отклонить': f'reject_user_{request_id}'}
         request_msg = await bot.send_message(chat_id=conf.tg_bot.GROUP_ID, text=text, reply_markup=custom_kb(2, btn))
-        request = get_request_from_id(request_id)
-        request.set('msg', request_msg.model_dump_json())
+        request = await get_request_from_id(session, request_id)
+        request.msg = request_msg.model_dump_json()
         await callback.message.answer(f'Ваша завка на новый канал № {request.id} отправлена. Ожидайте ответа.')
         await state.clear()
 
@@ -1,13 +1,21 @@
+import asyncio
+
 from aiogram import F, Bot, Router
+from aiogram.exceptions import TelegramBadRequest
 from aiogram.fsm.context import FSMContext
-from aiogram.types import CallbackQuery, FSInputFile
+from aiogram.types import CallbackQuery, BufferedInputFile
 from sqlalchemy import select
+from sqlalchemy.ext.asyncio import AsyncSession
 import pandas as pd
 
-from config_data.bot_conf import get_my_loggers, BASE_DIR
+from config_data.bot_conf import get_my_loggers
 from database.db import Session, Link
-from keyboards.keyboards import admin_start_kb
-from services.db_func import get_links, get_stats, save_stat_to_df
+from keyboards.keyboards import admin_start_kb, custom_kb
+from services.db_func import format_link_stats
+from services.db_func_async import get_link_stats
+from services.cache import export_file_cache
+from services.export import build_export, export_filename, export_fingerprint, EXPORT_BUILDERS
+from services.jobs import export_jobs
 
 router = Router()
 
@@ -15,24 +23,92 @@ logger, err_log = get_my_loggers()
 
 
 @router.callback_query(F.data == 'stats')
-async def stats(callback: CallbackQuery, state: FSMContext, bot: Bot):
+async def stats(callback: CallbackQuery, state: FSMContext, bot: Bot, session: AsyncSession):
     logger.debug('stats')
-    all_link = get_links()
+    # Одним агрегатным запросом за все три периода
+    link_stats = await get_link_stats(session, periods=(None, 30, 14))
     text = 'Статистика за весь период:\n'
-    text += get_stats(all_link)
+    text += format_link_stats(link_stats[None])
     text += '\nСтатистика за месяц:\n'
-    all_link = get_links(30)
-    text += get_stats(all_link)
+    text += format_link_stats(link_stats[30])
     text += '\nСтатистика за 2 недели:\n'
-    all_link = get_links(14)
-    text += get_stats(all_link)
+    text += format_link_stats(link_stats[14])
     await callback.message.edit_text(text=text, reply_markup=admin_start_kb)
 
 
+# Чаты, которые ждут файл, по задачам экспорта
+export_waiters: dict[asyncio.Future, set[int]] = {}
+
+
+async def deliver_export(bot: Bot, job: asyncio.Future, key: tuple):
+    """
+    Ждет завершения экспорта и отправляет файл всем, кто его запросил.
+    Файл загружается один раз, дальше и в следующие разы уходит по file_id.
+    """
+    chats = export_waiters[job]
+    try:
+        data = await job
+    except Exception as err:
+        err_log.error(f'Ошибка экспорта: {err}', exc_info=True)
+        while chats:
+            chat_id = chats.pop()
+            try:
+                await bot.send_message(chat_id=chat_id, text='Не удалось подготовить экспорт')
+            except Exception as send_err:
+                logger.warning(f'Не отправлено сообщение об ошибке экспорта в {chat_id}: {send_err}')
+        export_waiters.pop(job, None)
+        return
+    try:
+        file = BufferedInputFile(data, filename=export_filename(key[0]))
+        while chats:
+            chat_id = chats.pop()
+            # Ошибка одного чата (бот заблокирован, чат удален) не мешает остальным
+            try:
+                msg = await bot.send_document(chat_id=chat_id, document=export_file_cache.get(key) or file)
+            except Exception as err:
+                logger.warning(f'Файл экспорта не отправлен в {chat_id}: {err}')
+                continue
+            export_file_cache.set(key, msg.document.file_id)
+    finally:
+        export_waiters.pop(job, None)
+
+
 @router.callback_query(F.data == 'export')
-async def stats(callback: CallbackQuery, state: FSMContext, bot: Bot):
-    logger.debug('export')
-    save_stat_to_df()
-    file = FSInputFile(BASE_DIR / 'text.xlsx')
-    await bot.send_document(chat_id=callback.message.chat.id, document=file)
+async def export_menu(callback: CallbackQuery, state: FSMContext, bot: Bot):
+    kb = {
+        'Excel (лист на вэбмастера)': 'export:xlsx',
+        'CSV (все ролики)': 'export:csv',
+        'Parquet (все ролики)': 'export:parquet',
+        'Назад': 'cancel',
+    }
+    await callback.message.edit_text('Формат экспорта', reply_markup=custom_kb(1, kb))
+
 
+@router.callback_query(F.data.startswith('export:'))
+async def export(callback: CallbackQuery, state: FSMContext, bot: Bot, session: AsyncSession):
+    logger.debug(callback.data)
+    await callback.answer()
+    chat_id = callback.message.chat.id
+    fmt = callback.data.split('export:')[1]
+    if fmt not in EXPORT_BUILDERS:
+        return
+    key = (fmt, await export_fingerprint(session))
+    file_id = export_file_cache.get(key)
+    if file_id:
+        # Данные не менялись - отправляем прошлый файл без сборки и загрузки
+        try:
+            await bot.send_document(chat_id=chat_id, document=file_id)
+            return
+        except TelegramBadRequest as err:
+            logger.warning(f'file_id экспорта не принят: {err}')
+            export_file_cache.pop(key)
+    # Экспорт синхронный (xlsxwriter + psycopg2) - в пуле потоков, один запуск на всех
+    job, is_new = export_jobs.submit(key, build_export, fmt)
+    chats = export_waiters.setdefault(job, set())
+    if is_new:
+        asyncio.create_task(deliver_export(bot, job, key))
+    if chat_id in chats:
+        await callback.message.answer('Экспорт уже готовится, файл придет сюда')
+        return
+    chats.add(chat_id)
+    await callback.message.answer('Готовлю файл экспорта, пришлю когда будет готов')
@@ -8,14 +8,17 @@ from aiogram.fsm.state import StatesGroup, State
 from aiogram.types import CallbackQuery, Message, URLInputFile, ReplyKeyboardRemove, Chat
 
 from aiogram.fsm.context import FSMContext
+from sqlalchemy.ext.asyncio import AsyncSession
+from sqlalchemy.orm import joinedload
 
 from config_data.bot_conf import get_my_loggers, conf
-from database.db import User
+from database.db import User, Link
 from handlers.new_user import FSMCheckUser, FSMAnket
 from keyboards.keyboards import start_kb, contact_kb, admin_start_kb, custom_kb, menu_kb, kb_list
 from lexicon.lexicon import LEXICON
-from services.db_func import get_or_create_user, update_user, create_links, get_link_from_id, create_cash_outs, \
+from services.db_func_async import update_user, get_link_from_id, create_cash_outs, \
     get_cash_out_from_id, create_link, get_user_request_active
+from services.ledger import change_balance, CASH_OUT
 
 logger, err_log = get_my_loggers()
 
@@ -29,9 +32,12 @@ class IsPrivate(BaseFilter):
 
 
 class IsActive(BaseFilter):
-    async def __call__(self, message: Message | CallbackQuery, event_from_user) -> bool:
-        user = get_or_create_user(event_from_user)
-        return user.is_active
+    """
+    Активный вэбмастер. Юзера загружает middlewares/role.py.
+    Смотрим is_active, а не role: модератор может быть и вэбмастером.
+    """
+    async def __call__(self, message: Message | CallbackQuery, user: User | None) -> bool:
+        return bool(user and user.is_active)
 
 
 router: Router = Router()
@@ -49,9 +55,8 @@ class FSMCash(StatesGroup):
 
 
 @router.callback_query(F.data == 'support')
-async def support(callback: CallbackQuery, state: FSMContext, bot: Bot):
+async def support(callback: CallbackQuery, state: FSMContext, bot: Bot, user: User):
     text = LEXICON.get('support')
-    user = get_or_create_user()
     await bot.send_message(chat_id=conf.tg_bot.GROUP_ID, text=f'Запрос на связь от юзера {user}')
     await callback.message.edit_text(text, reply_markup=start_kb)
 
@@ -76,9 +81,8 @@ async def support(callback: CallbackQuery, state: FSMContext, bot: Bot):
 
 
 @router.callback_query(F.data == 'send_link')
-async def send_link(callback: CallbackQuery, state: FSMContext, bot: Bot):
-    user = get_or_create_user(callback.from_user)
-    active_requests = get_user_request_active(user.id)
+async def send_link(callback: CallbackQuery, state: FSMContext, bot: Bot, session: AsyncSession, user: User):
+    active_requests = await get_user_request_active(session, user.id)
     kb = {}
     text = 'Список ваших каналов:\n'
     for req in active_requests:
@@ -104,12 +108,11 @@ async def send_link(callback: CallbackQuery, state: FSMContext, bot: Bot):
 
 
 @router.message(StateFilter(FSMUser.send_link))
-async def receive_link(message: Message, state: FSMContext, bot: Bot):
+async def receive_link(message: Message, state: FSMContext, bot: Bot, session: AsyncSession, user: User):
     link = message.text.strip()
     if 'http' in link:
         await state.update_data(link=link)
         data = await state.get_data()
-        user = get_or_create_user(message.from_user)
         link_type = ''
         if 'tiktok.com' in link:
             link_type = 'tiktok'
@@ -118,7 +121,7 @@ async def receive_link(message: Message, state: FSMContext, bot: Bot):
         elif 'youtube.com' in link:
             link_type = 'youtube'
         request_id = data.get('channel_id')
-        link_id = create_link(user, link, link_type, request_id)
+        link_id = await create_link(session, user, link, link_type, request_id)
         if not link_type:
             await message.answer('Некорректная ссылка')
             await state.clear()
@@ -128,15 +131,14 @@ async def receive_link(message: Message, state: FSMContext, bot: Bot):
             await state.clear()
             return
         # Отправка на модерацию:
-        link = get_link_from_id(link_id)
+        link = await get_link_from_id(session, link_id, joinedload(Link.request))
         text = f'Юзер @{user.username or user.tg_id} выпустил новый ролик.\n{link.link}\nКанал: {link.request.channel_name}'
         # btn = {'Подтвердить': f'link_confirm_{link_id}', 'Отклонить': f'link_reject_{link_id}'}
         # msg = await bot.send_message(chat_id=conf.tg_bot.GROUP_ID, text=text, reply_markup=custom_kb(2, btn))
         msg = await bot.send_message(chat_id=conf.tg_bot.GROUP_ID, text=text)
         # msg = await bot.send_message(chat_id=conf.tg_bot.GROUP_ID, text=text)
         logger.debug(f'Ссылка {link_id} отправлена')
-        link.set('msg', msg.model_dump_json())
-        link.set('status', 'moderate')
+        await link.aupdate(session, msg=msg.model_dump_json(), status='moderate')
         await asyncio.sleep(0.2)
         await message.answer('Ссылка отправлена.', reply_markup=start_kb)
         # await callback.message.answer('Чат для модераторов: https://t.me/+llTdzJJuK0kwN2My')
@@ -147,23 +149,21 @@ async def receive_link(message: Message, state: FSMContext, bot: Bot):
 
 
 @router.message(StateFilter(FSMUser.input_date))
-async def input_date(message: Message, state: FSMContext, bot: Bot):
+async def input_date(message: Message, state: FSMContext, bot: Bot, session: AsyncSession, user: User):
     try:
         date = datetime.datetime.strptime(message.text.strip(), '%d.%m.%Y').date()
         data = await state.get_data()
         link = data.get('link')
-        user = get_or_create_user(message.from_user)
-        link_id = create_link(user, link, date)
+        link_id = await create_link(session, user, link, date)
         # Отправка на модерацию:
-        link = get_link_from_id(link_id)
+        link = await get_link_from_id(session, link_id)
         text = f'Юзер @{user.username or user.tg_id} выпустил новый ролик.\n{link.link}'
         # btn = {'Подтвердить': f'link_confirm_{link_id}', 'Отклонить': f'link_reject_{link_id}'}
         # msg = await bot.send_message(chat_id=conf.tg_bot.GROUP_ID, text=text, reply_markup=custom_kb(2, btn))
         msg = await bot.send_message(chat_id=conf.tg_bot.GROUP_ID, text=text)
         # msg = await bot.send_message(chat_id=conf.tg_bot.GROUP_ID, text=text)
         logger.debug(f'Ссылка {link_id} отправлена')
-        link.set('msg', msg.model_dump_json())
-        link.set('status', 'moderate')
+        await link.aupdate(session, msg=msg.model_dump_json(), status='moderate')
         await asyncio.sleep(0.2)
         await message.answer('Ссылка отправлена.', reply_markup=start_kb)
         # await callback.message.answer('Чат для модераторов: https://t.me/+llTdzJJuK0kwN2My')
@@ -204,8 +204,7 @@ def get_all_worked_link_count(user):
 
 # Купить Аккаунт
 @router.callback_query(F.data == 'buy_account')
-async def buy_account(callback: CallbackQuery, state: FSMContext, bot: Bot):
-    user = get_or_create_user(callback.from_user)
+async def buy_account(callback: CallbackQuery, state: FSMContext, bot: Bot, user: User):
     text = 'Доступные каналы:\n'
     btn = {
         'Купить': 'cash_out',
@@ -317,21 +316,19 @@ async def sell_account_confirm(callback: CallbackQuery, state: FSMContext, bot:
 
 
 @router.callback_query(F.data == 'balance')
-async def sell_account_confirm(callback: CallbackQuery, state: FSMContext, bot: Bot):
-    user = get_or_create_user(callback.from_user)
+async def sell_account_confirm(callback: CallbackQuery, state: FSMContext, bot: Bot, user: User):
     kb = {'Заявка на вывод средств': 'cash_out', 'Назад': 'cancel' }
     await callback.message.edit_text(f'Ваш баланс: {user.cash} руб.', reply_markup=custom_kb(1, kb))
 
 
 # Запрос на вывод средств
 @router.callback_query(F.data == 'cash_out')
-async def sell_account_confirm(callback: CallbackQuery, state: FSMContext, bot: Bot):
+async def sell_account_confirm(callback: CallbackQuery, state: FSMContext, bot: Bot, user: User):
 
     btn = {
         'Подтвердить': 'cash_out_confirm',
         'Отменить': 'cancel'
     }
-    user = get_or_create_user(callback.from_user)
     cash = user.cash
     text = f'Ваш баланс: {cash}\nОставить заявку на вывод?'
     if cash > 0:
@@ -348,14 +345,13 @@ async def cash_conf(callback: CallbackQuery, state: FSMContext, bot: Bot):
 
 
 @router.message(StateFilter(FSMCash.cost))
-async def cash_cost(message: Message, state: FSMContext):
+async def cash_cost(message: Message, state: FSMContext, user: User):
     trc20 = message.text.strip()
     try:
         btn = {
             'Подтвердить': f'cash_out_send',
             'Отменить': 'cancel'
         }
-        user = get_or_create_user(message.from_user)
         await state.update_data(trc20=trc20, cash=user.cash)
         await message.answer(f'Отправить заявку на вывод {user.cash} р. на кошелек {trc20}?', reply_markup=custom_kb(2, btn))
     except Exception as err:
@@ -364,23 +360,27 @@ async def cash_cost(message: Message, state: FSMContext):
 
 
 @router.callback_query(F.data == 'cash_out_send')
-async def cash_conf(callback: CallbackQuery, state: FSMContext, bot: Bot):
+async def cash_conf(callback: CallbackQuery, state: FSMContext, bot: Bot, session: AsyncSession, user: User):
     try:
         await callback.message.delete()
         data = await state.get_data()
         cash = data['cash']
         trc20 = data['trc20']
-        user = get_or_create_user(callback.from_user)
-        user.set('cash', 0)
-        user.set('trc20', trc20)
-        cash_out_id = create_cash_outs(user.id, cash, trc20)
+        entry = await change_balance(session, user.id, -cash, CASH_OUT)
+        if not entry:
+            await callback.message.answer('Недостаточный баланс')
+            await state.clear()
+            return
+        await user.aupdate(session, trc20=trc20)
+        cash_out_id = await create_cash_outs(session, user.id, cash, trc20)
+        entry.cash_out_id = cash_out_id
         btn = {'Подтвердить': f'cash_out_confirm:{cash_out_id}',
                'Отклонить': f'cash_out_reject:{cash_out_id}'}
         await callback.message.answer(f'Ваша заявка № {cash_out_id} на вывод {cash} р. отправлена')
         text = f'Заявка № {cash_out_id} на вывод {cash} р. от @{user.username or user.tg_id} на кошелек {trc20}'
         msg = await bot.send_message(chat_id=conf.tg_bot.GROUP_ID, text=text, reply_markup=custom_kb(2, btn))
-        cash_out = get_cash_out_from_id(cash_out_id)
-        cash_out.set('msg', msg.model_dump_json())
+        cash_out = await get_cash_out_from_id(session, cash_out_id)
+        cash_out.msg = msg.model_dump_json()
         await state.clear()
     except Exception as err:
         logger.error(err)
@@ -43,6 +43,7 @@ admin_start_kb_b = {
     'Ролики без выплат': 'videos',
     'Статистика': 'stats',
     'Экспорт статистики': 'export',
+    'Выплаты за месяц': 'payouts',
     # 'Заявки на проверку видео и зачисления баланса за них': 'link_list',
     # 'Заявки на покупку youtube акканута': 'buy_account_list',
     # 'Заявки на продажу аккаунта': 'sell_account_list',
@@ -5,8 +5,12 @@ from aiogram import Bot, Dispatcher
 import aioschedule
 
 from config_data.bot_conf import conf, get_my_loggers
+from database.db import async_session
+from database.migrate import migrate
 
 from handlers import user_handlers, echo, new_user, chat_handlers, admin_handlers, stats_handlers
+from middlewares.db import DbSessionMiddleware
+from middlewares.role import UserRoleMiddleware
 
 logger, err_log = get_my_loggers()
 
@@ -20,10 +24,16 @@ async def jobs():
 
 async def main():
     logger.info('Starting bot')
+    # Схема БД обновляется здесь, до приема апдейтов (при импорте моделей миграций нет)
+    migrate()
     bot: Bot = Bot(token=conf.tg_bot.token, parse_mode='HTML')
     dp: Dispatcher = Dispatcher()
 
     # asyncio.create_task(jobs())
+    # Одна сессия БД на апдейт
+    dp.update.outer_middleware(DbSessionMiddleware(async_session))
+    # Юзер и роль отправителя (после сессии)
+    dp.update.outer_middleware(UserRoleMiddleware())
     # Регистрируем
     dp.include_router(chat_handlers.router)
     dp.include_router(admin_handlers.router)
@@ -39,7 +49,8 @@ async def main():
                 conf.tg_bot.admin_ids[0], f'Бот запущен.\n{datetime.datetime.now()}')
     except Exception:
         err_log.error(f'Не могу отравить сообщение {conf.tg_bot.admin_ids[0]}')
-    await dp.start_polling(bot)
+    # chat_member приходит только если запрошен явно (нужен для кэша членства в группе)
+    await dp.start_polling(bot, allowed_updates=dp.resolve_used_update_types())
 
 
 if __name__ == '__main__':
@@ -0,0 +1,36 @@
+from typing import Any, Awaitable, Callable, Dict
+
+from aiogram import BaseMiddleware
+from aiogram.types import TelegramObject
+from sqlalchemy.ext.asyncio import async_sessionmaker
+
+from config_data.bot_conf import get_my_loggers
+
+logger, err_log = get_my_loggers()
+
+
+class DbSessionMiddleware(BaseMiddleware):
+    """
+    Одна сессия и одна транзакция на апдейт.
+    Сессия передается в хэндлеры и фильтры как session, commit делается один раз
+    после обработки. При исключении транзакция откатывается.
+    После commit вызываются колбэки из session.info['after_commit'] (сброс кэшей).
+    """
+
+    def __init__(self, session_pool: async_sessionmaker):
+        super().__init__()
+        self.session_pool = session_pool
+
+    async def __call__(
+            self,
+            handler: Callable[[TelegramObject, Dict[str, Any]], Awaitable[Any]],
+            event: TelegramObject,
+            data: Dict[str, Any],
+    ) -> Any:
+        async with self.session_pool() as session:
+            data['session'] = session
+            result = await handler(event, data)
+            await session.commit()
+            for callback in session.info.pop('after_commit', []):
+                callback()
+            return result
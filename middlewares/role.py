@@ -0,0 +1,71 @@
+from typing import Any, Awaitable, Callable, Dict
+
+from aiogram import BaseMiddleware, Bot
+from aiogram.enums import ChatMemberStatus
+from aiogram.types import TelegramObject, User as TgUser, Chat
+
+from config_data.bot_conf import get_my_loggers, conf
+from services.cache import member_cache
+from services.db_func_async import get_or_create_user
+
+logger, err_log = get_my_loggers()
+
+# Роли отправителя апдейта
+WEBMASTER = 'webmaster'
+INACTIVE = 'inactive'
+MODERATOR = 'moderator'
+GROUP = 'group'
+
+MODERATOR_STATUSES = (ChatMemberStatus.MEMBER, ChatMemberStatus.ADMINISTRATOR, ChatMemberStatus.CREATOR)
+
+
+class UserRoleMiddleware(BaseMiddleware):
+    """
+    Один раз на апдейт определяет отправителя и его роль.
+    В данные хэндлеров и фильтров кладет user (User из БД) и role:
+        group - апдейт из группы модераторов,
+        moderator - личный чат с участником группы модераторов,
+        webmaster / inactive - остальные, по User.is_active.
+    Регистрируется после DbSessionMiddleware: нужна session.
+    """
+
+    def __init__(self):
+        super().__init__()
+        self.group_id = int(conf.tg_bot.GROUP_ID)
+
+    async def is_moderator(self, bot: Bot, tg_user: TgUser) -> bool:
+        """Членство в группе модераторов: из member_cache, запрос в ТГ только при промахе"""
+        is_member = member_cache.get(tg_user.id)
+        if is_member is not None:
+            return is_member
+        try:
+            member = await bot.get_chat_member(chat_id=self.group_id, user_id=tg_user.id)
+        except Exception as err:
+            err_log.error(f'Не удалось проверить участника группы {tg_user.id}: {err}')
+            return False
+        is_member = member.status in MODERATOR_STATUSES
+        member_cache.set(tg_user.id, is_member)
+        return is_member
+
+    async def __call__(
+            self,
+            handler: Callable[[TelegramObject, Dict[str, Any]], Awaitable[Any]],
+            event: TelegramObject,
+            data: Dict[str, Any],
+    ) -> Any:
+        tg_user: TgUser = data.get('event_from_user')
+        chat: Chat = data.get('event_chat')
+        user = None
+        if tg_user and not tg_user.is_bot:
+            user = await get_or_create_user(data['session'], tg_user)
+        if chat and chat.id == self.group_id:
+            role = GROUP
+        elif tg_user and chat and chat.type == 'private' and await self.is_moderator(data['bot'], tg_user):
+            role = MODERATOR
+        elif user and user.is_active:
+            role = WEBMASTER
+        else:
+            role = INACTIVE
+        data['user'] = user
+        data['role'] = role
+        return await handler(event, data)
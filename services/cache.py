@@ -0,0 +1,82 @@
+import time
+from collections import OrderedDict
+from typing import Any, Hashable
+
+_missing = object()
+
+
+class TTLCache:
+    """
+    LRU-кэш в памяти процесса с временем жизни записей.
+    Счетчики hits/misses нужны, чтобы подобрать размер и ttl.
+    """
+
+    def __init__(self, maxsize: int = 1024, ttl: float = 60):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._data: OrderedDict[Hashable, tuple[float, Any]] = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key: Hashable, default=None):
+        item = self._data.get(key, _missing)
+        if item is _missing or item[0] < time.monotonic():
+            if item is not _missing:
+                del self._data[key]
+            self.misses += 1
+            return default
+        self._data.move_to_end(key)
+        self.hits += 1
+        return item[1]
+
+    def set(self, key: Hashable, value):
+        self._data[key] = (time.monotonic() + self.ttl, value)
+        self._data.move_to_end(key)
+        while len(self._data) > self.maxsize:
+            self._data.popitem(last=False)
+
+    def pop(self, key: Hashable, default=None):
+        item = self._data.pop(key, _missing)
+        return default if item is _missing else item[1]
+
+    def clear(self):
+        self._data.clear()
+
+    def __len__(self):
+        return len(self._data)
+
+    def stats(self) -> dict:
+        total = self.hits + self.misses
+        return {
+            'size': len(self._data),
+            'maxsize': self.maxsize,
+            'ttl': self.ttl,
+            'hits': self.hits,
+            'misses': self.misses,
+            'hit_rate': round(self.hits / total, 3) if total else 0,
+        }
+
+
+def invalidate(cache: TTLCache, key: Hashable, session=None):
+    """
+    Сбрасывает ключ сразу и, если передана сессия апдейта, еще раз после ее commit
+    (middlewares/db.py): иначе параллельный апдейт может успеть закэшировать старое значение.
+    """
+    cache.pop(key)
+    if session is not None:
+        session.info.setdefault('after_commit', []).append(lambda: cache.pop(key))
+
+
+# Пользователи по tg_id. Сбрасывается при любом изменении строки юзера
+user_cache = TTLCache(maxsize=10000, ttl=300)
+
+# Членство в группе модераторов по tg id: True/False.
+# Обновляется из апдейтов chat_member группы, ttl - на случай если бот их не получает
+member_cache = TTLCache(maxsize=10000, ttl=600)
+
+# Telegram file_id отправленных файлов экспорта по (формат, отпечаток данных)
+export_file_cache = TTLCache(maxsize=32, ttl=24 * 3600)
+
+# Карточка вэбмастера (WebUserMenu.get_stat) по id юзера.
+# Сбрасывается при изменении его роликов и заявок
+user_stat_cache = TTLCache(maxsize=1000, ttl=600)
@@ -1,13 +1,20 @@
 import asyncio
 import datetime
-
-import pandas as pd
-from sqlalchemy import select, delete, distinct, Row, RowMapping
+import re
+from itertools import groupby
+from pathlib import Path
+from operator import itemgetter
+
+import xlsxwriter
+from sqlalchemy import select, delete, func, Row, RowMapping
+from sqlalchemy.dialects.postgresql import insert
 from sqlalchemy.exc import IntegrityError
 from typing_extensions import Sequence
 
 from config_data.bot_conf import get_my_loggers, BASE_DIR
-from database.db import Session, User, Request, Link, CashOut
+from database.db import Session, User, Request, Link, CashOut, LinkDailyStats
+from services.cache import user_stat_cache
+from services.link_stats import link_stats_stmt
 
 logger, err_log = get_my_loggers()
 
@@ -39,25 +46,19 @@ def get_user_from_id(pk) -> User:
 
 
 def get_or_create_user(user) -> User:
-    """Из юзера ТГ возвращает сущестующего User ли создает его"""
+    """Из юзера ТГ возвращает сущестующего User ли создает его (INSERT ... ON CONFLICT (tg_id))"""
     try:
-        tg_id = user.id
-        username = user.username
-        logger.debug(f'username {username}')
-        old_user = check_user(tg_id)
-        if old_user:
-            logger.debug('Пользователь есть в базе')
-            return old_user
-        logger.debug('Добавляем пользователя')
-        with Session() as session:
-            new_user = User(tg_id=tg_id,
-                            username=username,
-                            register_date=datetime.datetime.now()
-                            )
-            session.add(new_user)
+        logger.debug(f'username {user.username}')
+        stmt = (
+            insert(User)
+            .values(tg_id=str(user.id), username=user.username, register_date=datetime.datetime.now())
+            .on_conflict_do_update(index_elements=[User.tg_id], set_={'username': user.username})
+            .returning(User)
+        )
+        with Session(expire_on_commit=False) as session:
+            db_user: User = session.execute(stmt).scalars().one()
             session.commit()
-            logger.debug(f'Пользователь создан: {new_user}')
-        return new_user
+        return db_user
     except Exception as err:
         err_log.error('Пользователь не создан', exc_info=True)
 
@@ -128,7 +129,10 @@ def create_link(user: User, link, link_type, request_id):
                         request_id=request_id
                         )
             session.add(link)
+            session.flush()
+            session.execute(link_stats_stmt(link, links=1))
             session.commit()
+            user_stat_cache.pop(link.owner_id)
             logger.debug('Запрос сохранен')
             return link.id
     except IntegrityError as err:
@@ -201,32 +205,17 @@ def get_cash_out_from_id(pk) -> CashOut:
         return cash_out
 
 
-def get_stats(queryset):
+def format_link_stats(stats: dict) -> str:
+    """Текст статистики из get_link_stats: {link_type: (links, views, cost)}, итог под ключом None"""
     link_types = ['youtube', 'instagram', 'tiktok']
     text = ''
-
     for link_type in link_types:
-        link_count = 0
-        view_count = 0
-        cost = 0
+        link_count, view_count, cost = stats.get(link_type, (0, 0, 0))
         text += f'{link_type}\n'
-        for link in queryset:
-            if link.link_type == link_type:
-                link_count += 1
-                view_count += link.view_count
-                cost += link.cost
-
         text += f'Ссылок: {link_count}.'
         text += f' Просмотров: {view_count}.'
         text += f' Выплат: {cost}.\n'
-
-    link_count = 0
-    view_count = 0
-    cost = 0
-    for link in queryset:
-        link_count += 1
-        view_count += link.view_count
-        cost += link.cost
+    link_count, view_count, cost = stats.get(None, (0, 0, 0))
     text += f'Итого Ссылок: {link_count} Просмотров: {view_count} Выплат: {cost}\n'
     return text
 
@@ -241,37 +230,74 @@ def get_links(period=None) -> Sequence[Link]:
         return all_link
 
 
-def save_stat_to_df():
+EXPORT_COLUMNS = ['id', 'Дата', 'Cссылка', 'Источник', 'Просмотры', 'Выплата', 'username']
+
+
+def sheet_title(name, used: set) -> str:
+    """Имя листа Excel: до 31 символа, без []:*?/\\ и кавычек по краям, без повторов (без учета регистра)"""
+    title = re.sub(r'[\[\]:*?/\\]', '_', str(name))[:31].strip("'") or '-'
+    base, num = title, 1
+    while title.lower() in used:
+        suffix = f' ({num})'
+        title = base[:31 - len(suffix)] + suffix
+        num += 1
+    used.add(title.lower())
+    return title
+
+
+def export_links_xlsx(session, output):
+    """
+    Статистика в excel за один проход: один xlsxwriter в режиме constant_memory
+    (строки сразу уходят во временные файлы), лист Info с итогами из сводки
+    и лист на каждого вэбмастера. Все ролики с username владельца читаются одним запросом
+    через серверный курсор порциями, число запросов не зависит от числа вэбмастеров.
+    output - путь или бинарный буфер (BytesIO).
+    """
+    if isinstance(output, Path):
+        output = str(output)
+    workbook = xlsxwriter.Workbook(output, {'constant_memory': True,
+                                               'strings_to_urls': False,
+                                               'strings_to_formulas': False})
+    try:
+        used = set()
+        info = workbook.add_worksheet(sheet_title('Info', used))
+        info.write_row(0, 0, ['Источник', 'Ссылок', 'Просмотры', 'Выплаты'])
+        q = (
+            select(LinkDailyStats.link_type,
+                   func.sum(LinkDailyStats.links), func.sum(LinkDailyStats.views), func.sum(LinkDailyStats.cost))
+            .group_by(LinkDailyStats.link_type)
+            .order_by(LinkDailyStats.link_type)
+        )
+        for num, row in enumerate(session.execute(q), 1):
+            info.write_row(num, 0, row)
+
+        # Один запрос на все ролики, упорядоченный по владельцу: листы собираются по ходу чтения
+        q = (
+            select(Link.owner_id, User.username, Link.id, Link.register_date, Link.link, Link.link_type,
+                   Link.view_count, Link.cost)
+            .join(User, User.id == Link.owner_id)
+            .order_by(Link.owner_id, Link.link_type.asc(), Link.register_date.asc())
+            .execution_options(yield_per=5000)
+        )
+        rows = session.execute(q)
+        for (owner_id, username), user_links in groupby(rows, key=itemgetter(0, 1)):
+            sheet = workbook.add_worksheet(sheet_title(username, used))
+            sheet.write_row(0, 0, EXPORT_COLUMNS)
+            for num, (_, _, link_id, register_date, link, link_type, view_count, cost) in enumerate(user_links, 1):
+                date = register_date.strftime('%d.%m.%Y') if register_date else ''
+                sheet.write_row(num, 0, [link_id, date, link, link_type, view_count, cost, username])
+    finally:
+        workbook.close()
+
+
+def save_stat_to_df(path=None):
     """
     Сохраняет статистике в файл excel
     """
-    path = BASE_DIR / 'text.xlsx'
-    session = Session(expire_on_commit=False)
-    with session:
-        all_users = select(distinct(Link.owner_id))
-        all_users: Sequence[Link] = session.execute(all_users).scalars().all()
-        with pd.ExcelWriter(path, engine="openpyxl", mode="w") as writer:
-            pd.DataFrame().to_excel(writer, sheet_name='Info', startrow=0, startcol=0)
-
-        for user_id in all_users:
-            q = select(Link).where(Link.owner_id == user_id).order_by(Link.link_type.asc(), Link.register_date.asc())
-            user_links: list[Link] = session.execute(q).scalars().all()
-            print(user_links)
-            user = get_user_from_id(user_id)
-            columns = ['id', 'Дата', 'Cссылка', 'Источник', 'Просмотры', 'Выплата', 'username']
-            rows = []
-            for link in user_links:
-                row = [link.id,
-                       link.register_date.strftime('%d.%m.%Y'),
-                       link.link,
-                       link.link_type,
-                       link.view_count,
-                       link.cost,
-                       link.owner.username]
-                rows.append(row)
-            df_to_save = pd.DataFrame(data=rows, index=None, columns=columns)
-            with pd.ExcelWriter(path, engine="openpyxl", mode="a") as writer:
-                df_to_save.to_excel(writer, sheet_name=str(f'{user.username}'), index=False, startrow=0, startcol=0)
+    path = path or BASE_DIR / 'text.xlsx'
+    with Session() as session:
+        export_links_xlsx(session, path)
+    return path
 
 
 if __name__ == '__main__':
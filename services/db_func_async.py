@@ -0,0 +1,216 @@
+"""
+Асинхронные версии функций из services/db_func.py для хэндлеров.
+Синхронные функции остаются для скриптов.
+
+Все функции работают в сессии апдейта (middlewares/db.py) и не делают commit:
+изменения фиксируются одной транзакцией в конце обработки апдейта.
+"""
+import datetime
+from typing import Sequence
+
+from sqlalchemy import select, func, true, and_
+from sqlalchemy.dialects.postgresql import insert
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from config_data.bot_conf import get_my_loggers, tz
+from database.db import User, Request, Link, CashOut, LinkDailyStats
+from database.read_models import RegRow
+from services.cache import user_cache
+from services.link_stats import add_link_stats
+from services.work_queue import claimable
+
+logger, err_log = get_my_loggers()
+
+
+async def check_user(session: AsyncSession, id) -> User:
+    """Возвращает найденных пользователей по tg_id"""
+    q = select(User).filter(User.tg_id == str(id))
+    user: User = (await session.execute(q)).scalars().one_or_none()
+    return user
+
+
+async def get_user_from_id(session: AsyncSession, pk, *options) -> User:
+    q = select(User).filter(User.id == pk).options(*options)
+    user = (await session.execute(q)).scalars().one_or_none()
+    return user
+
+
+async def get_or_create_user(session: AsyncSession, user) -> User:
+    """
+    Из юзера ТГ возвращает сущестующего User ли создает его.
+    Сначала смотрит в кэш (services/cache.py), иначе один запрос
+    INSERT ... ON CONFLICT (tg_id) DO UPDATE ... RETURNING:
+    заодно обновляет username и не создает дублей при одновременных апдейтах.
+    Возвращаемый объект отвязан от сессии - изменять его через aupdate.
+    В кэш он попадает после commit транзакции апдейта (session.info['after_commit']).
+    Ошибку БД не глотает: хэндлеры рассчитывают на user из UserRoleMiddleware.
+    """
+    try:
+        tg_id = str(user.id)
+        cached: User = user_cache.get(tg_id)
+        if cached and cached.username == user.username:
+            return cached
+        logger.debug(f'username {user.username}')
+        stmt = (
+            insert(User)
+            .values(tg_id=tg_id, username=user.username, register_date=datetime.datetime.now())
+            .on_conflict_do_update(index_elements=[User.tg_id], set_={'username': user.username})
+            .returning(User)
+            .execution_options(populate_existing=True)
+        )
+        db_user: User = (await session.execute(stmt)).scalars().one()
+        session.expunge(db_user)
+        # В кэш - только после commit: при откате апдейта строки юзера в БД может не быть
+        session.info.setdefault('after_commit', []).append(lambda: user_cache.set(tg_id, db_user))
+        return db_user
+    except Exception:
+        # Транзакция апдейта уже прервана: обработку продолжать нельзя, DbSessionMiddleware откатит ее
+        err_log.error('Пользователь не создан', exc_info=True)
+        raise
+
+
+async def update_user(session: AsyncSession, user: User, data: dict):
+    try:
+        logger.debug(f'Обновляем {user}: {data}')
+        await user.aupdate(session, **data)
+        logger.debug(f'Юзер обновлен {user}')
+    except Exception:
+        # Как в get_or_create_user: транзакцию апдейта откатит DbSessionMiddleware
+        err_log.error(f'Ошибка обновления юзера {user}', exc_info=True)
+        raise
+
+
+async def create_request(session: AsyncSession, user: User, text, source, channel_name):
+    logger.debug(f'Сохраняем запрос')
+    request = Request(
+        user_id=user.id,
+        text=text,
+        source=source,
+        channel_name=channel_name
+    )
+    session.add(request)
+    await session.flush()
+    logger.debug('Запрос сохранен')
+    return request.id
+
+
+async def get_request_from_id(session: AsyncSession, pk, *options) -> Request:
+    """options - опции загрузки связей, например joinedload(Request.owner)"""
+    q = select(Request).filter(Request.id == pk).options(*options)
+    req: Request = (await session.execute(q)).scalars().one_or_none()
+    return req
+
+
+async def get_user_request_active(session: AsyncSession, user_id) -> Sequence[Request]:
+    q = select(Request).filter(Request.user_id == user_id, Request.status == 1)
+    req = (await session.execute(q)).scalars().all()
+    return req
+
+
+async def create_link(session: AsyncSession, user: User, link, link_type, request_id):
+    try:
+        link = Link(owner_id=user.id,
+                    link=link,
+                    link_type=link_type,
+                    request_id=request_id
+                    )
+        # Savepoint: дубль ссылки не должен ломать всю транзакцию апдейта
+        async with session.begin_nested():
+            session.add(link)
+            await session.flush()
+            await add_link_stats(session, link, links=1)
+        logger.debug('Запрос сохранен')
+        return link.id
+    except IntegrityError as err:
+        logger.error(err)
+
+
+async def get_link_from_id(session: AsyncSession, pk, *options) -> Link:
+    try:
+        q = select(Link).filter(Link.id == pk).options(*options)
+        link = (await session.execute(q)).scalars().one_or_none()
+        return link
+    except Exception:
+        err_log.error(f'Ошибка получения ролика {pk}', exc_info=True)
+        raise
+
+
+async def get_reg_from_id(session: AsyncSession, pk, *options) -> Request:
+    q = select(Request).filter(Request.id == pk).options(*options)
+    reg = (await session.execute(q)).scalars().one_or_none()
+    return reg
+
+
+async def create_cash_outs(session: AsyncSession, user_id, cost, trc20) -> int:
+    cash_out = CashOut(user_id=user_id, cost=cost, trc20=trc20)
+    session.add(cash_out)
+    await session.flush()
+    logger.debug('Запрос на вывод сохранен')
+    return cash_out.id
+
+
+async def get_cash_out_from_id(session: AsyncSession, pk) -> CashOut:
+    q = select(CashOut).filter(CashOut.id == pk)
+    cash_out = (await session.execute(q)).scalars().one_or_none()
+    return cash_out
+
+
+async def get_link_stats(session: AsyncSession, periods=(None, 30, 14)) -> dict:
+    """
+    Статистика роликов одним запросом по сводке link_daily_stats: для каждого периода
+    (дней, None - весь период) количество, просмотры и выплаты по link_type и итог (ключ None, из ROLLUP).
+    Период считается целыми днями: сегодня и period предыдущих дней.
+    {period: {link_type: (links, views, cost)}}
+    """
+    today = datetime.datetime.now(tz=tz).date()
+    columns = []
+    for period in periods:
+        cond = LinkDailyStats.day >= today - datetime.timedelta(days=period) if period else true()
+        columns += [
+            func.coalesce(func.sum(LinkDailyStats.links).filter(cond), 0),
+            func.coalesce(func.sum(LinkDailyStats.views).filter(cond), 0),
+            func.coalesce(func.sum(LinkDailyStats.cost).filter(cond), 0),
+        ]
+    q = (
+        select(LinkDailyStats.link_type, func.grouping(LinkDailyStats.link_type), *columns)
+        .group_by(func.rollup(LinkDailyStats.link_type))
+    )
+    stats = {period: {} for period in periods}
+    for link_type, is_total, *values in (await session.execute(q)).all():
+        key = None if is_total else link_type
+        for num, period in enumerate(periods):
+            stats[period][key] = tuple(values[num * 3: num * 3 + 3])
+    return stats
+
+
+async def get_users_with_uncofirmed_link(session: AsyncSession, limit=100, moderator_id=None) -> Sequence[User]:
+    """
+    Возвращает пользователей у которых есть ролики без просмотров (view_count = 0)
+    moderator_id: без роликов, взятых в работу другими модераторами
+    :return:
+    """
+    cond = Link.view_count == 0
+    if moderator_id:
+        cond = and_(cond, claimable(Link, moderator_id))
+    q = select(User).where(User.links.any(cond)).order_by(User.id).limit(limit)
+    users = (await session.execute(q)).scalars().all()
+    return users
+
+
+def _reg_rows_query():
+    return select(Request.id, Request.text, User.id, User.username).join(User, User.id == Request.user_id)
+
+
+async def get_unconfirmed_reg(session: AsyncSession, limit=5, moderator_id=None) -> list[RegRow]:
+    """Заявки на модерации. moderator_id: без заявок, взятых в работу другими модераторами"""
+    q = _reg_rows_query().where(Request.status == 0)
+    if moderator_id:
+        q = q.where(claimable(Request, moderator_id))
+    q = q.order_by(Request.id).limit(limit)
+    return [RegRow(*row) for row in (await session.execute(q)).all()]
+
+
+async def get_reg_row(session: AsyncSession, pk) -> RegRow | None:
+    row = (await session.execute(_reg_rows_query().where(Request.id == pk))).one_or_none()
+    return RegRow(*row) if row else None
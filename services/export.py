@@ -0,0 +1,145 @@
+"""
+Отчеты для выгрузки. Построитель пишет отчет в бинарный буфер,
+build_export возвращает готовые байты: файл не пишется на диск
+и у каждого запроса свой результат.
+Новый формат - функция (session, buffer) в EXPORT_BUILDERS.
+Отправленные файлы кэшируются по отпечатку данных (export_fingerprint):
+без изменений в роликах, юзерах и заявках повторный экспорт уходит по Telegram file_id без сборки и загрузки.
+
+Плоская выгрузка всех роликов (csv, parquet) читается из БД порциями,
+в памяти одновременно только одна порция. Из консоли тот же конвейер пишет сразу в файл:
+    python -m services.export csv -o links.csv
+    python -m services.export parquet -o links.parquet
+"""
+import argparse
+import csv
+import datetime
+import io
+from typing import BinaryIO, Callable, Iterator, Sequence
+
+import pyarrow as pa
+import pyarrow.parquet as pq
+from sqlalchemy import select, func, Row
+from sqlalchemy.ext.asyncio import AsyncSession
+from sqlalchemy.orm import Session as SyncSession
+
+from config_data.bot_conf import get_my_loggers, tz
+from database.db import Session, Link, User, Request
+from services.db_func import export_links_xlsx
+
+logger, err_log = get_my_loggers()
+
+CHUNK_SIZE = 10000
+FLAT_COLUMNS = ['id', 'date', 'link', 'link_type', 'views', 'cost', 'username', 'channel', 'cpm']
+
+
+def iter_link_chunks(session: SyncSession, chunk_size: int = CHUNK_SIZE) -> Iterator[Sequence[Row]]:
+    """Все ролики с username и каналом порциями по chunk_size строк (серверный курсор)"""
+    q = (
+        select(Link.id, Link.register_date, Link.link, Link.link_type, Link.view_count, Link.cost,
+               User.username, Request.channel_name, Request.cpm)
+        .join(User, User.id == Link.owner_id)
+        .outerjoin(Request, Request.id == Link.request_id)
+        .order_by(Link.id)
+        .execution_options(yield_per=chunk_size)
+    )
+    yield from session.execute(q).partitions()
+
+
+def build_xlsx(session: SyncSession, buffer: BinaryIO):
+    export_links_xlsx(session, buffer)
+
+
+def build_csv(session: SyncSession, buffer: BinaryIO):
+    # utf-8-sig: Excel открывает кириллицу без выбора кодировки
+    text = io.TextIOWrapper(buffer, encoding='utf-8-sig', newline='')
+    writer = csv.writer(text)
+    writer.writerow(FLAT_COLUMNS)
+    for chunk in iter_link_chunks(session):
+        writer.writerows(
+            (link_id, register_date.isoformat() if register_date else '', *rest)
+            for link_id, register_date, *rest in chunk
+        )
+    text.flush()
+    # Буфер остается открытым для вызывающего
+    text.detach()
+
+
+def build_parquet(session: SyncSession, buffer: BinaryIO):
+    schema = pa.schema([
+        ('id', pa.int64()),
+        ('date', pa.timestamp('us', tz='UTC')),
+        ('link', pa.string()),
+        ('link_type', pa.string()),
+        ('views', pa.int64()),
+        ('cost', pa.int64()),
+        ('username', pa.string()),
+        ('channel', pa.string()),
+        ('cpm', pa.float64()),
+    ])
+    # Каждая порция - отдельная row group
+    with pq.ParquetWriter(buffer, schema) as writer:
+        for chunk in iter_link_chunks(session):
+            columns = list(zip(*chunk))
+            writer.write_table(pa.Table.from_arrays(
+                [pa.array(values, type=field.type) for values, field in zip(columns, schema)],
+                schema=schema,
+            ))
+
+
+EXPORT_BUILDERS: dict[str, Callable[[SyncSession, BinaryIO], None]] = {
+    'xlsx': build_xlsx,
+    'csv': build_csv,
+    'parquet': build_parquet,
+}
+
+
+async def export_fingerprint(session: AsyncSession) -> tuple:
+    """
+    Отпечаток данных экспорта: максимальный id ролика и последние изменения роликов,
+    юзеров (username) и заявок (канал, cpm). Пока он не меняется, готовый файл можно
+    отправить повторно по file_id. Каждое значение - один шаг по индексу, без чтения таблиц.
+    Ролики бот не удаляет, поэтому число строк не считается.
+    updated_at ставится clock_timestamp() в момент UPDATE: изменение, закоммиченное позже
+    более нового, теряется только если транзакции пересеклись - у апдейта бота это доли секунды.
+    """
+    q = select(
+        select(func.max(Link.id)).scalar_subquery(),
+        select(func.max(Link.updated_at)).scalar_subquery(),
+        select(func.max(User.updated_at)).scalar_subquery(),
+        select(func.max(Request.updated_at)).scalar_subquery(),
+    )
+    return tuple((await session.execute(q)).one())
+
+
+def export_filename(fmt: str) -> str:
+    return f'stats_{datetime.datetime.now(tz=tz):%Y%m%d_%H%M}.{fmt}'
+
+
+def write_export(fmt: str, output: BinaryIO):
+    """Пишет отчет в формате fmt в бинарный поток"""
+    with Session() as session:
+        EXPORT_BUILDERS[fmt](session, output)
+
+
+def build_export(fmt: str = 'xlsx') -> bytes:
+    """Строит отчет в формате fmt в памяти. Синхронная - запускать в пуле (services/jobs.py)"""
+    buffer = io.BytesIO()
+    write_export(fmt, buffer)
+    logger.debug(f'Экспорт {fmt}: {buffer.tell()} байт')
+    return buffer.getvalue()
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Экспорт статистики роликов')
+    parser.add_argument('format', choices=list(EXPORT_BUILDERS))
+    parser.add_argument('-o', '--output', help='Файл, по умолчанию stats_<дата>.<формат>')
+    args = parser.parse_args()
+    path = args.output or export_filename(args.format)
+    with open(path, 'wb') as file:
+        write_export(args.format, file)
+    print(f'Сохранено: {path}')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,42 @@
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, Hashable
+
+from config_data.bot_conf import get_my_loggers
+
+logger, err_log = get_my_loggers()
+
+
+class JobRunner:
+    """
+    Тяжелые синхронные задачи (экспорт) в ограниченном пуле потоков, чтобы не блокировать event loop.
+    Не больше max_workers задач одновременно, остальные ждут в очереди пула.
+    Повторный запуск задачи с тем же ключом, пока она выполняется, возвращает уже запущенную.
+    """
+
+    def __init__(self, max_workers: int = 2, name: str = 'job'):
+        self.name = name
+        self.executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix=name)
+        self._running: dict[Hashable, asyncio.Future] = {}
+
+    def submit(self, key: Hashable, func: Callable, *args) -> tuple[asyncio.Future, bool]:
+        """Возвращает (future задачи, True если задача запущена этим вызовом)"""
+        future = self._running.get(key)
+        if future is not None:
+            logger.debug(f'{self.name} {key} уже выполняется')
+            return future, False
+        future = asyncio.get_running_loop().run_in_executor(self.executor, func, *args)
+        self._running[key] = future
+        future.add_done_callback(lambda _: self._running.pop(key, None))
+        logger.debug(f'{self.name} {key} запущена')
+        return future, True
+
+    def is_running(self, key: Hashable) -> bool:
+        return key in self._running
+
+    def shutdown(self):
+        self.executor.shutdown(wait=False, cancel_futures=True)
+
+
+# Экспорт статистики: не больше двух файлов одновременно
+export_jobs = JobRunner(max_workers=2, name='export')
@@ -0,0 +1,167 @@
+"""
+Баланс вэбмастеров.
+Баланс меняется только атомарным UPDATE users SET cash = cash + amount на стороне БД,
+каждое изменение пишется в журнал cash_ledger. Так несколько модераторов могут
+одновременно начислять одному вэбмастеру без потери обновлений.
+
+Проверка и заполнение журнала для старых балансов:
+    python -m services.ledger backfill
+    python -m services.ledger check
+"""
+import argparse
+import asyncio
+from collections import defaultdict
+from typing import Sequence
+
+from sqlalchemy import update, select, func, insert, values, column, Integer, Row
+from sqlalchemy.ext.asyncio import AsyncSession
+from sqlalchemy.orm.attributes import set_committed_value
+
+from config_data.bot_conf import get_my_loggers
+from database.db import User, CashLedger, async_session
+from services.cache import user_cache, invalidate
+
+logger, err_log = get_my_loggers()
+
+# Виды операций
+LINK_PAYOUT = 'link_payout'
+CASH_OUT = 'cash_out'
+DEACTIVATION_PAYOUT = 'deactivation_payout'
+PAYOUT_RUN = 'payout_run'
+OPENING = 'opening'
+
+
+async def change_balance(session: AsyncSession, user_id: int, amount: int, kind: str,
+                         link_id=None, cash_out_id=None, moderator_id=None) -> CashLedger | None:
+    """
+    Атомарно изменяет баланс на amount и добавляет запись в журнал.
+    Списание (amount < 0) не уводит баланс в минус: если денег не хватает, возвращает None.
+    """
+    # Баланса нет в экспорте: отпечаток экспорта (updated_at) не меняется
+    stmt = update(User).where(User.id == user_id).values(cash=User.cash + amount, updated_at=User.updated_at)
+    if amount < 0:
+        stmt = stmt.where(User.cash >= -amount)
+    stmt = stmt.returning(User.cash, User.tg_id).execution_options(synchronize_session=False)
+    row = (await session.execute(stmt)).one_or_none()
+    if row is None:
+        logger.debug(f'Недостаточно средств у {user_id} для операции {kind} {amount}')
+        return None
+    balance, tg_id = row
+    invalidate(user_cache, tg_id, session)
+    # Объект юзера в сессии мог устареть - обновляем без лишнего запроса
+    user = session.identity_map.get(session.identity_key(User, user_id))
+    if user is not None:
+        set_committed_value(user, 'cash', balance)
+    entry = CashLedger(user_id=user_id, amount=amount, balance=balance, kind=kind,
+                       link_id=link_id, cash_out_id=cash_out_id, moderator_id=moderator_id)
+    session.add(entry)
+    await session.flush()
+    logger.debug(f'Баланс {user_id} изменен на {amount} ({kind}): {balance}')
+    return entry
+
+
+async def add_to_balances(session: AsyncSession, totals: dict[int, int]) -> dict[int, int]:
+    """
+    Пакетно прибавляет {user_id: amount} к балансам одним UPDATE ... FROM (VALUES ...).
+    Юзеры, у которых баланс ушел бы в минус, не меняются. Возвращает {user_id: новый баланс}.
+    Записи в журнал добавляет вызывающий.
+    """
+    if not totals:
+        return {}
+    amounts = values(column('user_id', Integer), column('amount', Integer), name='amounts').data(list(totals.items()))
+    stmt = (
+        update(User)
+        .where(User.id == amounts.c.user_id, User.cash + amounts.c.amount >= 0)
+        .values(cash=User.cash + amounts.c.amount, updated_at=User.updated_at)
+        .returning(User.id, User.cash, User.tg_id)
+        .execution_options(synchronize_session=False)
+    )
+    balances = {}
+    for user_id, cash, tg_id in (await session.execute(stmt)).all():
+        balances[user_id] = cash
+        invalidate(user_cache, tg_id, session)
+        user = session.identity_map.get(session.identity_key(User, user_id))
+        if user is not None:
+            set_committed_value(user, 'cash', cash)
+    return balances
+
+
+async def credit_balances(session: AsyncSession, credits: Sequence[tuple[int, int, int]], kind: str,
+                          moderator_id=None) -> dict[int, int]:
+    """
+    Пакетное начисление: credits - (user_id, amount, link_id), amount >= 0.
+    Одно обновление балансов и одна вставка в журнал,
+    запись журнала на каждую операцию с балансом после нее. Возвращает {user_id: новый баланс}.
+    """
+    totals = defaultdict(int)
+    for user_id, amount, _ in credits:
+        totals[user_id] += amount
+    balances = await add_to_balances(session, totals)
+    # Баланс после каждой операции: от итогового назад
+    running = {user_id: cash - totals[user_id] for user_id, cash in balances.items()}
+    entries = []
+    for user_id, amount, link_id in credits:
+        if user_id not in running:
+            continue
+        running[user_id] += amount
+        entries.append({'user_id': user_id, 'amount': amount, 'balance': running[user_id], 'kind': kind,
+                        'link_id': link_id, 'moderator_id': moderator_id})
+    if entries:
+        await session.execute(insert(CashLedger), entries)
+    logger.debug(f'Начислено {kind}: {len(entries)} операций, {len(balances)} юзеров')
+    return balances
+
+
+def _ledger_mismatch_query():
+    """(user_id, cash, сумма по журналу) юзеров, у которых баланс не совпадает с журналом"""
+    ledger_sum = (
+        select(CashLedger.user_id, func.sum(CashLedger.amount).label('total'))
+        .group_by(CashLedger.user_id)
+        .subquery()
+    )
+    total = func.coalesce(ledger_sum.c.total, 0)
+    return (
+        select(User.id, User.cash, total)
+        .outerjoin(ledger_sum, ledger_sum.c.user_id == User.id)
+        .where(User.cash != total)
+        .order_by(User.id)
+    )
+
+
+async def backfill_opening_balances(session: AsyncSession) -> int:
+    """
+    Записывает в журнал начальный баланс: разницу между User.cash и суммой журнала.
+    Учитывает и юзеров, которым бот уже успел что-то начислить до запуска backfill.
+    """
+    # Строки юзеров блокируются: параллельное начисление не попадет между расчетом и записью
+    q = _ledger_mismatch_query().with_for_update(of=User)
+    users = (await session.execute(q)).all()
+    for user_id, cash, total in users:
+        session.add(CashLedger(user_id=user_id, amount=cash - total, balance=cash, kind=OPENING))
+    await session.flush()
+    return len(users)
+
+
+async def check_ledger(session: AsyncSession) -> Sequence[Row]:
+    """Возвращает (user_id, cash, ledger_sum) юзеров, у которых баланс не совпадает с журналом"""
+    return (await session.execute(_ledger_mismatch_query())).all()
+
+
+async def main():
+    parser = argparse.ArgumentParser(description='Журнал баланса')
+    parser.add_argument('command', choices=['backfill', 'check'])
+    args = parser.parse_args()
+    async with async_session() as session:
+        if args.command == 'backfill':
+            count = await backfill_opening_balances(session)
+            await session.commit()
+            print(f'Добавлено начальных записей: {count}')
+        else:
+            wrong = await check_ledger(session)
+            for user_id, cash, total in wrong:
+                print(f'Юзер {user_id}: баланс {cash}, по журналу {total}')
+            print(f'Расхождений: {len(wrong)}')
+
+
+if __name__ == '__main__':
+    asyncio.run(main())
@@ -0,0 +1,166 @@
+"""
+Сводка роликов по дням (таблица link_daily_stats).
+Ключ: день (по tz бота), link_type, owner_id, request_id. Значения: количество роликов,
+просмотры и выплаты. Строки обновляются инкрементально при создании ролика
+и назначении просмотров, статистика и экспорт читают сводку вместо links.
+
+Пустая сводка заполняется из links при миграции (database/migrate.py). Пересчет и проверка расхождений:
+    python -m services.link_stats backfill
+    python -m services.link_stats check
+"""
+import argparse
+import asyncio
+import datetime
+from collections import defaultdict
+from typing import Iterable, Sequence
+
+from sqlalchemy import select, func, delete, and_, or_, text, Row
+from sqlalchemy.dialects.postgresql import insert
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from config_data.bot_conf import get_my_loggers, tz
+from database.db import Link, LinkDailyStats, async_session
+from services.cache import user_stat_cache, invalidate
+
+logger, err_log = get_my_loggers()
+
+KEY_COLUMNS = ('day', 'link_type', 'owner_id', 'request_id')
+# Строк в одном INSERT пакетного обновления (лимит параметров asyncpg)
+UPSERT_BATCH = 1000
+
+
+def link_day(link: Link) -> datetime.date:
+    register_date = link.register_date or datetime.datetime.now(tz=tz)
+    return register_date.astimezone(tz).date()
+
+
+def _upsert_stmt(rows: dict | list[dict]):
+    """INSERT ... ON CONFLICT DO UPDATE: прибавляет значения к строкам сводки"""
+    stmt = insert(LinkDailyStats).values(rows)
+    return stmt.on_conflict_do_update(
+        constraint='uq_link_daily_stats',
+        set_={
+            'links': LinkDailyStats.links + stmt.excluded.links,
+            'views': LinkDailyStats.views + stmt.excluded.views,
+            'cost': LinkDailyStats.cost + stmt.excluded.cost,
+        },
+    )
+
+
+def _stats_key(link) -> tuple:
+    return link_day(link), link.link_type, link.owner_id, link.request_id
+
+
+def link_stats_stmt(link: Link, links=0, views=0, cost=0):
+    """Прибавляет значения к строке дня ролика"""
+    return _upsert_stmt(dict(zip(KEY_COLUMNS, _stats_key(link)), links=links, views=views, cost=cost))
+
+
+async def add_link_stats_bulk(session: AsyncSession, changes: Iterable[tuple]):
+    """
+    Пакетный вариант add_link_stats: changes - (ролик, links, views, cost).
+    Ролик - Link или строка с register_date, link_type, owner_id, request_id.
+    Изменения складываются по ключу сводки и пишутся одним INSERT ... ON CONFLICT
+    (в одной команде ключ не может повторяться).
+    """
+    totals = defaultdict(lambda: [0, 0, 0])
+    for link, *deltas in changes:
+        total = totals[_stats_key(link)]
+        for num, delta in enumerate(deltas):
+            total[num] += delta
+    if not totals:
+        return
+    rows = [dict(zip(KEY_COLUMNS, key), links=links, views=views, cost=cost)
+            for key, (links, views, cost) in totals.items()]
+    for start in range(0, len(rows), UPSERT_BATCH):
+        await session.execute(_upsert_stmt(rows[start:start + UPSERT_BATCH]))
+    for owner_id in {key[2] for key in totals}:
+        invalidate(user_stat_cache, owner_id, session)
+
+
+async def add_link_stats(session: AsyncSession, link: Link, links=0, views=0, cost=0):
+    """Учитывает изменение ролика в сводке в транзакции апдейта"""
+    await session.execute(link_stats_stmt(link, links, views, cost))
+    # Карточка вэбмастера считается по сводке
+    invalidate(user_stat_cache, link.owner_id, session)
+
+
+def links_by_day():
+    """Агрегат links с тем же ключом, что у сводки"""
+    day = func.date(func.timezone(tz.zone, Link.register_date))
+    return (
+        select(
+            day.label('day'), Link.link_type, Link.owner_id, Link.request_id,
+            func.count(Link.id).label('links'),
+            func.coalesce(func.sum(Link.view_count), 0).label('views'),
+            func.coalesce(func.sum(Link.cost), 0).label('cost'),
+        )
+        .group_by(day, Link.link_type, Link.owner_id, Link.request_id)
+    )
+
+
+def fill_empty_link_stats(conn) -> int:
+    """
+    Заполняет сводку из links, если она пустая, а ролики есть (первый запуск после появления таблицы).
+    Синхронная, для миграции схемы (database/migrate.py): без этого статистика, экспорт и карточки показывали бы нули
+    до ручного backfill.
+    """
+    conn.execute(text('LOCK TABLE link_daily_stats IN EXCLUSIVE MODE'))
+    if conn.execute(select(LinkDailyStats.id).limit(1)).first() or not conn.execute(select(Link.id).limit(1)).first():
+        return 0
+    result = conn.execute(insert(LinkDailyStats).from_select([*KEY_COLUMNS, 'links', 'views', 'cost'], links_by_day()))
+    logger.info(f'Сводка link_daily_stats заполнена из links: {result.rowcount} строк')
+    return result.rowcount
+
+
+async def backfill_link_stats(session: AsyncSession) -> int:
+    """Полностью пересчитывает сводку из links"""
+    # Блокировка ждет открытые транзакции бота, новые будут ждать конца пересчета
+    await session.execute(text('LOCK TABLE link_daily_stats IN EXCLUSIVE MODE'))
+    await session.execute(delete(LinkDailyStats))
+    source = links_by_day()
+    result = await session.execute(
+        insert(LinkDailyStats).from_select([*KEY_COLUMNS, 'links', 'views', 'cost'], source)
+    )
+    return result.rowcount
+
+
+async def check_link_stats(session: AsyncSession) -> Sequence[Row]:
+    """
+    Сравнивает сводку с links. Возвращает расхождения:
+    (day, link_type, owner_id, request_id, links, views, cost, stat_links, stat_views, stat_cost)
+    """
+    actual = links_by_day().subquery()
+    stats = LinkDailyStats
+    on = and_(*(getattr(actual.c, key).is_not_distinct_from(getattr(stats, key)) for key in KEY_COLUMNS))
+    values = [func.coalesce(getattr(actual.c, key), 0) for key in ('links', 'views', 'cost')]
+    stat_values = [func.coalesce(getattr(stats, key), 0) for key in ('links', 'views', 'cost')]
+    q = (
+        select(
+            *(func.coalesce(getattr(actual.c, key), getattr(stats, key)) for key in KEY_COLUMNS),
+            *values, *stat_values,
+        )
+        .select_from(actual.join(stats, on, full=True))
+        .where(or_(*(value != stat_value for value, stat_value in zip(values, stat_values))))
+    )
+    return (await session.execute(q)).all()
+
+
+async def main():
+    parser = argparse.ArgumentParser(description='Сводка роликов по дням')
+    parser.add_argument('command', choices=['backfill', 'check'])
+    args = parser.parse_args()
+    async with async_session() as session:
+        if args.command == 'backfill':
+            count = await backfill_link_stats(session)
+            await session.commit()
+            print(f'Строк в сводке: {count}')
+        else:
+            wrong = await check_link_stats(session)
+            for row in wrong:
+                print(*row)
+            print(f'Расхождений: {len(wrong)}')
+
+
+if __name__ == '__main__':
+    asyncio.run(main())
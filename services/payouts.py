@@ -0,0 +1,192 @@
+"""
+Выплаты вэбмастерам за период одной операцией.
+Оцененные ролики (cost > 0), еще не вошедшие в выплату, загружаются колонками в pandas,
+итоги по вэбмастерам считаются векторно. Сумма выплаты - начисленная стоимость роликов,
+но не больше текущего баланса (часть могла быть выведена заявками на вывод).
+Контрольно стоимость пересчитывается по текущему cpm канала: расхождения видны в отчете.
+
+Проведение в одной транзакции: списание балансов, заявки CashOut (status=1), записи журнала,
+отметка роликов payout_run_id. Повторно те же ролики в выплату не попадут.
+
+    python -m services.payouts preview 2026-09-01 2026-10-01 -o payouts.csv
+    python -m services.payouts commit 2026-09-01 2026-10-01
+"""
+import argparse
+import asyncio
+import datetime
+import io
+
+import numpy as np
+import pandas as pd
+from sqlalchemy import select, update, insert, any_, literal, ARRAY, Integer
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from config_data.bot_conf import get_my_loggers, tz
+from database.db import Link, Request, User, CashOut, CashLedger, PayoutRun, async_session
+from services.ledger import add_to_balances, PAYOUT_RUN
+
+logger, err_log = get_my_loggers()
+
+REPORT_COLUMNS = ['user_id', 'username', 'trc20', 'links', 'views', 'cost', 'recalc', 'cash', 'payout', 'note']
+
+
+def month_period(months_ago: int = 1) -> tuple[datetime.datetime, datetime.datetime]:
+    """Календарный месяц по tz бота: 0 - текущий, 1 - прошлый"""
+    start = datetime.datetime.now(tz=tz).replace(day=1, hour=0, minute=0, second=0, microsecond=0)
+    for _ in range(months_ago):
+        start = (start - datetime.timedelta(days=1)).replace(day=1)
+    end = (start + datetime.timedelta(days=32)).replace(day=1)
+    return tz.localize(start.replace(tzinfo=None)), tz.localize(end.replace(tzinfo=None))
+
+
+def _ids(ids):
+    # Один параметр-массив вместо IN (...) на тысячи значений
+    return any_(literal([int(pk) for pk in ids], ARRAY(Integer)))
+
+
+async def load_unsettled_links(session: AsyncSession, start: datetime.datetime, end: datetime.datetime,
+                               lock=False) -> pd.DataFrame:
+    """Оцененные ролики периода [start, end) без выплаты: link_id, user_id, views, cost, cpm"""
+    q = (
+        select(Link.id, Link.owner_id, Link.view_count, Link.cost, Request.cpm)
+        .outerjoin(Request, Request.id == Link.request_id)
+        .where(Link.cost > 0, Link.payout_run_id.is_(None),
+               Link.register_date >= start, Link.register_date < end)
+    )
+    if lock:
+        # Параллельная выплата за пересекающийся период ждет конца этой
+        q = q.with_for_update(of=Link)
+    rows = (await session.execute(q)).all()
+    return pd.DataFrame.from_records(rows, columns=['link_id', 'user_id', 'views', 'cost', 'cpm'])
+
+
+async def load_users(session: AsyncSession, user_ids) -> pd.DataFrame:
+    q = select(User.id, User.username, User.trc20, User.cash).where(User.id == _ids(user_ids))
+    rows = (await session.execute(q)).all()
+    return pd.DataFrame.from_records(rows, columns=['user_id', 'username', 'trc20', 'cash']).set_index('user_id')
+
+
+def compute_payouts(links: pd.DataFrame, users: pd.DataFrame) -> pd.DataFrame:
+    """Итоги по вэбмастерам и сумма к выплате. Строка на вэбмастера, колонки REPORT_COLUMNS"""
+    if links.empty:
+        return pd.DataFrame(columns=REPORT_COLUMNS)
+    links = links.assign(
+        recalc=np.floor(links['views'].to_numpy() / 1000 * links['cpm'].fillna(0).to_numpy()).astype('int64')
+    )
+    report = links.groupby('user_id').agg(
+        links=('link_id', 'size'), views=('views', 'sum'), cost=('cost', 'sum'), recalc=('recalc', 'sum'),
+    ).join(users)
+    has_wallet = report['trc20'].fillna('').str.strip() != ''
+    cash = report['cash'].fillna(0).clip(lower=0).astype('int64')
+    report['payout'] = np.where(has_wallet, np.minimum(report['cost'], cash), 0)
+    report['note'] = np.select(
+        [~has_wallet, report['payout'] < report['cost'], report['recalc'] != report['cost']],
+        ['нет кошелька', 'баланс меньше суммы', 'cpm изменился после оценки'],
+        '',
+    )
+    return report.reset_index()[REPORT_COLUMNS].sort_values('payout', ascending=False, ignore_index=True)
+
+
+async def preview_payouts(session: AsyncSession, start: datetime.datetime, end: datetime.datetime,
+                          lock=False) -> tuple[pd.DataFrame, pd.DataFrame]:
+    """(ролики, отчет по вэбмастерам) за период без изменений в БД"""
+    links = await load_unsettled_links(session, start, end, lock=lock)
+    users = await load_users(session, links['user_id'].unique())
+    return links, compute_payouts(links, users)
+
+
+def report_summary(report: pd.DataFrame, start: datetime.datetime, end: datetime.datetime) -> str:
+    paid = report[report['payout'] > 0]
+    text = (
+        f'Выплата за {start:%d.%m.%Y} - {(end - datetime.timedelta(days=1)):%d.%m.%Y}\n'
+        f'Вэбмастеров: {len(paid)} из {len(report)}\n'
+        f'Роликов: {int(paid["links"].sum())}, просмотров: {int(paid["views"].sum())}\n'
+        f'К выплате: {int(paid["payout"].sum())} рублей\n'
+    )
+    for note, count in report.loc[report['note'] != '', 'note'].value_counts().items():
+        text += f'{note}: {count}\n'
+    return text
+
+
+def report_csv(report: pd.DataFrame) -> bytes:
+    buffer = io.StringIO()
+    report.to_csv(buffer, index=False)
+    return buffer.getvalue().encode('utf-8-sig')
+
+
+async def commit_payout_run(session: AsyncSession, start: datetime.datetime, end: datetime.datetime,
+                            moderator_id=None, expected_total=None) -> tuple[PayoutRun | None, pd.DataFrame]:
+    """
+    Проводит выплату за период в транзакции сессии (без commit).
+    expected_total - сумма из предпросмотра: если данные с тех пор изменились, выплата не проводится.
+    Возвращает (выплата или None, если платить некому или сумма изменилась, отчет).
+    """
+    links, report = await preview_payouts(session, start, end, lock=True)
+    payouts = report[report['payout'] > 0]
+    if payouts.empty:
+        return None, report
+    if expected_total is not None and int(payouts['payout'].sum()) != expected_total:
+        logger.info(f'Выплата за {start} - {end}: сумма изменилась с предпросмотра ({expected_total})')
+        return None, report
+    totals = dict(zip(payouts['user_id'].tolist(), (-payouts['payout']).tolist()))
+    balances = await add_to_balances(session, totals)
+    # Баланс могли уменьшить после расчета - такие вэбмастера в выплату не входят
+    payouts = payouts[payouts['user_id'].isin(balances)]
+    if payouts.empty:
+        return None, report
+    run = PayoutRun(moderator_id=moderator_id, period_start=start, period_end=end)
+    session.add(run)
+    await session.flush()
+    user_ids = payouts['user_id'].tolist()
+    cash_outs = (await session.execute(
+        insert(CashOut).returning(CashOut.id, CashOut.user_id, sort_by_parameter_order=True),
+        [{'user_id': user_id, 'cost': cost, 'trc20': trc20, 'status': 1, 'moderator_id': moderator_id,
+          'payout_run_id': run.id}
+         for user_id, cost, trc20 in zip(user_ids, payouts['payout'].tolist(), payouts['trc20'].tolist())],
+    )).all()
+    cash_out_ids = {user_id: pk for pk, user_id in cash_outs}
+    await session.execute(insert(CashLedger), [
+        {'user_id': user_id, 'amount': amount, 'balance': balances[user_id], 'kind': PAYOUT_RUN,
+         'cash_out_id': cash_out_ids[user_id], 'moderator_id': moderator_id}
+        for user_id, amount in totals.items() if user_id in balances
+    ])
+    link_ids = links.loc[links['user_id'].isin(user_ids), 'link_id']
+    await session.execute(
+        update(Link).where(Link.id == _ids(link_ids))
+        .values(payout_run_id=run.id, updated_at=Link.updated_at)
+        .execution_options(synchronize_session=False)
+    )
+    run.users = len(user_ids)
+    run.links = len(link_ids)
+    run.total = int(payouts['payout'].sum())
+    logger.info(f'Выплата {run.id}: {run.users} вэбмастеров, {run.links} роликов, {run.total} рублей')
+    return run, report
+
+
+def _date(value: str) -> datetime.datetime:
+    return tz.localize(datetime.datetime.strptime(value, '%Y-%m-%d'))
+
+
+async def main():
+    parser = argparse.ArgumentParser(description='Выплаты вэбмастерам за период')
+    parser.add_argument('command', choices=['preview', 'commit'])
+    parser.add_argument('start', type=_date, help='Начало периода, ГГГГ-ММ-ДД')
+    parser.add_argument('end', type=_date, help='Конец периода (не включая), ГГГГ-ММ-ДД')
+    parser.add_argument('-o', '--output', help='Сохранить отчет в csv')
+    args = parser.parse_args()
+    async with async_session() as session:
+        if args.command == 'preview':
+            _, report = await preview_payouts(session, args.start, args.end)
+        else:
+            run, report = await commit_payout_run(session, args.start, args.end)
+            await session.commit()
+            print(f'Проведена выплата {run.id}' if run else 'Платить некому')
+    print(report_summary(report, args.start, args.end))
+    if args.output:
+        with open(args.output, 'wb') as file:
+            file.write(report_csv(report))
+        print(f'Сохранено: {args.output}')
+
+
+if __name__ == '__main__':
+    asyncio.run(main())
@@ -0,0 +1,158 @@
+"""
+Пакетное назначение просмотров роликам.
+Модератор присылает CSV/XLSX или вставляет строки "link_id view_count".
+Файл проверяется целиком: при ошибках ничего не применяется.
+Стоимость считается в БД одним UPDATE links ... FROM (VALUES ...) JOIN requests:
+cost = floor(views / 1000 * cpm), как в change_view. Просмотры, сводка link_daily_stats,
+балансы и журнал меняются в одной транзакции апдейта.
+"""
+import csv
+import io
+import re
+from dataclasses import dataclass, field
+from typing import Iterable
+
+from sqlalchemy import select, update, values, column, cast, func, Integer
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from config_data.bot_conf import get_my_loggers
+from database.db import Link, Request
+from services.ledger import credit_balances, LINK_PAYOUT
+from services.link_stats import add_link_stats_bulk
+from services.work_queue import claimable
+
+logger, err_log = get_my_loggers()
+
+# Параметров в одной команде asyncpg не больше 32767: по два на ролик
+MAX_ROWS = 10000
+MAX_ERRORS = 20
+
+
+@dataclass
+class PricingResult:
+    priced: int = 0
+    views: int = 0
+    cost: int = 0
+    users: int = 0
+    not_found: list[int] = field(default_factory=list)
+    already_priced: list[int] = field(default_factory=list)
+    claimed: list[int] = field(default_factory=list)
+
+    def summary(self) -> str:
+        text = (
+            f'Оценено роликов: {self.priced}\n'
+            f'Просмотров: {self.views}\n'
+            f'Начислено: {self.cost} рублей ({self.users} вэбмастеров)\n'
+        )
+        for name, ids in (('Не найдены', self.not_found), ('Уже оценены', self.already_priced),
+                          ('В работе у других модераторов', self.claimed)):
+            if ids:
+                text += f'{name} ({len(ids)}): {", ".join(map(str, ids[:50]))}\n'
+        return text
+
+
+def read_rows(data: bytes, filename: str = '') -> Iterable[list]:
+    """Строки файла: xlsx - первый лист, иначе текст (csv или вставленные строки)"""
+    if filename.lower().endswith('.xlsx'):
+        import openpyxl
+        book = openpyxl.load_workbook(io.BytesIO(data), read_only=True, data_only=True)
+        for row in book.active.iter_rows(values_only=True):
+            yield [cell for cell in row if cell is not None]
+        book.close()
+        return
+    text = data.decode('utf-8-sig')
+    try:
+        dialect = csv.Sniffer().sniff(text[:4096], delimiters=',;\t')
+    except csv.Error:
+        # Вставленные строки "123 4500"
+        yield from (re.split(r'[\s,;]+', line.strip()) for line in text.splitlines())
+        return
+    yield from csv.reader(io.StringIO(text), dialect)
+
+
+def _to_int(value) -> int:
+    if isinstance(value, float) and value.is_integer():
+        return int(value)
+    return int(str(value).strip().replace(' ', ''))
+
+
+def parse_view_counts(rows: Iterable[list]) -> tuple[dict[int, int], list[str]]:
+    """
+    Проверяет строки "link_id, view_count". Возвращает ({link_id: просмотры}, ошибки).
+    Пустые строки и заголовок пропускаются.
+    """
+    counts = {}
+    errors = []
+    for num, row in enumerate(rows, 1):
+        row = [cell for cell in row if str(cell).strip()]
+        if not row:
+            continue
+        if len(row) < 2:
+            errors.append(f'Строка {num}: нужно два значения - id ролика и просмотры')
+            continue
+        try:
+            link_id, views = _to_int(row[0]), _to_int(row[1])
+        except ValueError:
+            if num == 1:
+                continue
+            errors.append(f'Строка {num}: не числа {row[0]!r}, {row[1]!r}')
+            continue
+        if link_id <= 0 or views <= 0:
+            errors.append(f'Строка {num}: id и просмотры должны быть больше нуля')
+        elif counts.get(link_id, views) != views:
+            errors.append(f'Строка {num}: ролик {link_id} уже указан с просмотрами {counts[link_id]}')
+        else:
+            counts[link_id] = views
+        if len(counts) > MAX_ROWS:
+            errors.append(f'Больше {MAX_ROWS} роликов в одном файле')
+            break
+        if len(errors) >= MAX_ERRORS:
+            break
+    if not counts and not errors:
+        errors.append('Нет ни одной строки "id ролика, просмотры"')
+    return counts, errors
+
+
+async def apply_view_counts(session: AsyncSession, counts: dict[int, int], moderator_id: int) -> PricingResult:
+    """
+    Назначает просмотры и стоимость роликам без просмотров (view_count = 0), кроме взятых
+    в работу другими модераторами, и начисляет выплаты. Без commit - в транзакции апдейта.
+    """
+    result = PricingResult()
+    if not counts:
+        return result
+    rows = values(column('link_id', Integer), column('views', Integer), name='counts').data(list(counts.items()))
+    stmt = (
+        update(Link)
+        .where(Link.id == rows.c.link_id, Request.id == Link.request_id,
+               Link.view_count == 0, claimable(Link, moderator_id))
+        .values(view_count=rows.c.views, cost=cast(func.floor(rows.c.views / 1000 * Request.cpm), Integer),
+                claimed_by=None, claimed_until=None)
+        .returning(Link.id, Link.owner_id, Link.register_date, Link.link_type, Link.request_id,
+                   Link.view_count, Link.cost)
+        .execution_options(synchronize_session=False)
+    )
+    priced = (await session.execute(stmt)).all()
+    await credit_balances(session, [(link.owner_id, link.cost, link.id) for link in priced],
+                          LINK_PAYOUT, moderator_id=moderator_id)
+    await add_link_stats_bulk(session, ((link, 0, link.view_count, link.cost) for link in priced))
+
+    result.priced = len(priced)
+    result.views = sum(link.view_count for link in priced)
+    result.cost = sum(link.cost for link in priced)
+    result.users = len({link.owner_id for link in priced})
+    # Почему остальные не оценены
+    skipped = set(counts) - {link.id for link in priced}
+    if skipped:
+        q = select(Link.id, Link.view_count).where(Link.id.in_(skipped))
+        found = dict((await session.execute(q)).all())
+        for link_id in sorted(skipped):
+            if link_id not in found:
+                result.not_found.append(link_id)
+            elif found[link_id]:
+                result.already_priced.append(link_id)
+            else:
+                result.claimed.append(link_id)
+    logger.info(f'Модератор {moderator_id}: оценено {result.priced} роликов на {result.cost}, '
+                f'пропущено {len(skipped)}')
+    return result
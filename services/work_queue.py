@@ -0,0 +1,94 @@
+"""
+Очередь модерации: заявки на каналы (status = 0) и ролики без просмотров (view_count = 0, как в compare-and-set оценки).
+Модератор берет следующую свободную запись: UPDATE ... WHERE id = (SELECT ... FOR UPDATE SKIP LOCKED).
+Строку, которую в эту же секунду берет другой модератор, запрос пропускает, а не ждет,
+и каждый получает свою запись. Взятая запись закреплена за модератором на CLAIM_LEASE (claimed_by, claimed_until),
+после этого срока брошенная запись снова попадает в очередь.
+Сама обработка по-прежнему защищена compare-and-set в aupdate (expect={'status': 0} и т.п.).
+"""
+import datetime
+
+from sqlalchemy import select, update, func, or_
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from config_data.bot_conf import get_my_loggers
+from database.db import Request, Link
+
+logger, err_log = get_my_loggers()
+
+CLAIM_LEASE = datetime.timedelta(minutes=15)
+
+
+def claimable(model, moderator_id: int):
+    """Запись свободна или уже закреплена за этим модератором"""
+    return or_(model.claimed_until.is_(None), model.claimed_until < func.now(), model.claimed_by == moderator_id)
+
+
+def _claim_values(model, moderator_id: int | None) -> dict:
+    return {
+        'claimed_by': moderator_id,
+        'claimed_until': func.now() + CLAIM_LEASE if moderator_id else None,
+        # Закрепление не меняет данные: отпечаток экспорта (updated_at) остается прежним
+        'updated_at': model.updated_at,
+    }
+
+
+async def _claim_next(session: AsyncSession, model, pending, order_by, moderator_id: int) -> int | None:
+    candidate = (
+        select(model.id)
+        .where(pending, claimable(model, moderator_id))
+        # Сначала своя незаконченная запись
+        .order_by(model.claimed_by.is_distinct_from(moderator_id), *order_by)
+        .limit(1)
+        .with_for_update(skip_locked=True)
+        .scalar_subquery()
+    )
+    stmt = update(model).where(model.id == candidate).values(**_claim_values(model, moderator_id)).returning(model.id)
+    pk = (await session.execute(stmt.execution_options(synchronize_session=False))).scalar()
+    logger.debug(f'{model.__tablename__}: модератор {moderator_id} взял {pk}')
+    return pk
+
+
+async def claim_next_request(session: AsyncSession, moderator_id: int) -> int | None:
+    """Берет следующую заявку на канал. Возвращает id или None, если очередь пуста"""
+    return await _claim_next(session, Request, Request.status == 0, (Request.id,), moderator_id)
+
+
+async def claim_next_link(session: AsyncSession, moderator_id: int) -> int | None:
+    """Берет следующий неоцененный ролик (старые первыми). Возвращает id или None"""
+    return await _claim_next(session, Link, Link.view_count == 0, (Link.register_date, Link.id), moderator_id)
+
+
+async def claim(session: AsyncSession, model, pk: int, moderator_id: int) -> bool:
+    """Берет конкретную запись перед обработкой. False - она в работе у другого модератора"""
+    stmt = (
+        update(model)
+        .where(model.id == pk, claimable(model, moderator_id))
+        .values(**_claim_values(model, moderator_id))
+        .returning(model.id)
+        .execution_options(synchronize_session=False)
+    )
+    return (await session.execute(stmt)).scalar() is not None
+
+
+async def release_all(session: AsyncSession, moderator_id: int):
+    """Возвращает в очередь все записи модератора (выход в главное меню)"""
+    for model in (Request, Link):
+        stmt = (
+            update(model)
+            .where(model.claimed_by == moderator_id)
+            .values(**_claim_values(model, None))
+            .execution_options(synchronize_session=False)
+        )
+        await session.execute(stmt)
+
+
+async def release(session: AsyncSession, model, pk: int, moderator_id: int):
+    """Возвращает запись в очередь"""
+    stmt = (
+        update(model)
+        .where(model.id == pk, model.claimed_by == moderator_id)
+        .values(**_claim_values(model, None))
+        .execution_options(synchronize_session=False)
+    )
+    await session.execute(stmt)